@@ -1,5 +1,5 @@
 # GUI which displays data from the mat interpreted by the PMI (Pressure Matrix Interface) and transmitted over serial
-import sys, os, re
+import sys, os, re, time
 import numpy as np
 
 from PyQt6.QtGui import  *
@@ -8,9 +8,18 @@ from PyQt6.QtCore import *
 
 from pathlib import Path
 
-from modules.calibration import Calibration, CalSampleWorker, MAX_RATED_PRESSURE_PA, DEFAULT_CAL_CURVES_PATH
-from modules.communicator import SessionWorker, ROW_WIDTH, COL_HEIGHT
+from modules.acquisition import ACQUISITION_MODE_LOSSLESS, ACQUISITION_MODE_LATEST
+from modules.calibration import Calibration, load_calibration_readings, MAX_RATED_PRESSURE_PA, DEFAULT_CAL_CURVES_PATH
+from modules.communicator import SessionWorker, CalSampleWorker, CalibrationWorker, ROW_WIDTH, COL_HEIGHT
 from modules.mat_handler import calc_mat_reading_stats
+from modules.multi_mat import MatConfig, MultiMatSession, tile_frames
+from modules.playback import SessionPlayback
+from modules.renderer import PressureRenderer, COLORMAP_ANCHORS, DEFAULT_COLORMAP
+
+DISPLAY_REFRESH_HZ = 30     # default rate at which the newest frame of a live session is drawn
+STATS_REFRESH_HZ = 5        # rate at which reading statistics are recalculated for a live session
+MULTI_MAT_COLUMNS = 2       # number of mats drawn in each column when recording several mats
+STOP_POLL_INTERVAL_MS = 100 # how often a stopping multi mat session is checked for having written out its sessions
 
 
 class MainWindow(QMainWindow):
@@ -24,11 +33,14 @@ class MainWindow(QMainWindow):
         # Path of the npy file that is currently being rendered
         self.current_img_path = None
 
+        # playback of the past session that is currently loaded, if one is
+        self.playback = None
+
         self.layout = QGridLayout()
         
-        # com port input box
+        # com port input box. Several comma separated ports record every mat at once
         self.port_input = QLineEdit("COM3", self)
-        self.layout.addWidget(QLabel("Port:", self), 1, 0)
+        self.layout.addWidget(QLabel("Port(s):", self), 1, 0)
         self.layout.addWidget(self.port_input, 2, 0)
 
         # baud rate input box
@@ -37,6 +49,12 @@ class MainWindow(QMainWindow):
         self.layout.addWidget(QLabel("Baud rate:", self), 1, 1)
         self.layout.addWidget(self.baud_input, 2, 1)
 
+        # comma separated calibration curves for a multi mat session, either one for every mat or one per port.
+        # Left empty, every mat uses the current calibration
+        self.cal_curves_input = QLineEdit("", self)
+        self.cal_curves_input.setPlaceholderText("Calibration curves per mat (optional)")
+        self.layout.addWidget(self.cal_curves_input, 3, 0)
+
         # start/stop mat recording session
         self.start_session_b = QPushButton("Start Session")
         self.start_session_b.clicked.connect(self.start_session)
@@ -49,12 +67,27 @@ class MainWindow(QMainWindow):
         self.layout.addWidget(self.stop_session_b, 6, 0)
         self.layout.addWidget(self.session_status, 5, 2)
         self.layout.addWidget(self.session_stats, 6, 2)
+
+        # record raw readings (calibrated on playback) instead of calibrated pressures
+        self.record_raw_cb = QCheckBox("Record raw readings")
+        self.layout.addWidget(self.record_raw_cb, 5, 1)
+
+        # only process the newest frame when the GUI falls behind the mat, for live feedback with bounded latency
+        self.latest_frame_cb = QCheckBox("Latest frame only (low latency)")
+        self.layout.addWidget(self.latest_frame_cb, 4, 1)
         
         # load past session
         self.load_past_session_b = QPushButton("Load Past Session")
         self.load_past_session_b.clicked.connect(self.load_past_session)
         self.layout.addWidget(self.load_past_session_b, 7, 0)
 
+        # play back raw sessions with the current calibration instead of the one they were recorded with
+        self.recalibrate_playback_cb = QCheckBox("Recalibrate raw sessions")
+        self.recalibrate_playback_cb.toggled.connect(
+            lambda checked: self.set_playback_calibration()
+        )
+        self.layout.addWidget(self.recalibrate_playback_cb, 7, 1)
+
         # zero mat
         self.zero_mat_b = QPushButton("Zero Mat")
         self.zero_mat_b.clicked.connect(self.zero_mat)
@@ -62,6 +95,13 @@ class MainWindow(QMainWindow):
         self.layout.addWidget(self.zero_mat_b, 8, 0)
         self.layout.addWidget(self.zeroing_status, 8, 1)
 
+        # fit new calibration curves to a folder of readings saved by resources/get_mat_data.py
+        self.recalibrate_b = QPushButton("Recalibrate From Readings")
+        self.recalibrate_b.clicked.connect(self.recalibrate)
+        self.recalibration_status = QLabel("Status: Using loaded curves")
+        self.layout.addWidget(self.recalibrate_b, 9, 0)
+        self.layout.addWidget(self.recalibration_status, 9, 1)
+
         # navigate images with slider
         self.slider = QSlider(Qt.Orientation.Horizontal, self)
         self.slider.setTickInterval(1)
@@ -69,13 +109,50 @@ class MainWindow(QMainWindow):
         self.slider.setMaximum(0)
         self.slider.valueChanged.connect(self.get_npy_file_from_slider)
         self.layout.addWidget(self.slider, 1, 2)
+
+        # shows the time of the current frame, and jumps to the frame at the time typed in, for sessions with timestamps
+        self.seek_time_input = QDoubleSpinBox(self)
+        self.seek_time_input.setDecimals(3)
+        self.seek_time_input.setSuffix(" s")
+        self.seek_time_input.setEnabled(False)
+        self.seek_time_input.editingFinished.connect(self.seek_to_time)
+        self.layout.addWidget(self.seek_time_input, 2, 2)
    
         # set up image label
         self.im_size = QSize(COL_HEIGHT*10, ROW_WIDTH*10)
         self.im_label = QLabel()
         self.qimage = QImage()
+        self.renderer = PressureRenderer((ROW_WIDTH, COL_HEIGHT), MAX_RATED_PRESSURE_PA)
         self.layout.addWidget(self.im_label, 0, 2)
 
+        # select the colormap pressures are drawn with
+        self.colormap_input = QComboBox(self)
+        self.colormap_input.addItems(list(COLORMAP_ANCHORS))
+        self.colormap_input.setCurrentText(DEFAULT_COLORMAP)
+        self.colormap_input.currentTextChanged.connect(self.renderer.set_colormap)
+        self.layout.addWidget(self.colormap_input, 6, 1)
+
+        # the rate at which live sessions are drawn, independent of the rate the mat is read at
+        self.display_hz_input = QSpinBox(self)
+        self.display_hz_input.setRange(1, 120)
+        self.display_hz_input.setValue(DISPLAY_REFRESH_HZ)
+        self.display_hz_input.setSuffix(" Hz display")
+        self.display_hz_input.valueChanged.connect(
+            lambda hz: self.display_timer.setInterval(1000 // hz)
+        )
+        self.layout.addWidget(self.display_hz_input, 7, 2)
+
+        # pulls the newest frame and statistics out of the session worker at the display rate
+        self.display_timer = QTimer(self)
+        self.display_timer.setInterval(1000 // DISPLAY_REFRESH_HZ)
+        self.display_timer.timeout.connect(self.refresh_live_display)
+        self.last_stats_time = 0
+
+        # checks whether a stopping multi mat session has finished, so its threads are never waited on by the GUI thread
+        self.stop_poll_timer = QTimer(self)
+        self.stop_poll_timer.setInterval(STOP_POLL_INTERVAL_MS)
+        self.stop_poll_timer.timeout.connect(self.finish_multi_mat_session)
+
         # add a label for showing stats about the image
         self.mat_stats_label = QLabel("Mat reading stats:\nNone")
         self.layout.addWidget(self.mat_stats_label, 0, 1)
@@ -96,6 +173,11 @@ class MainWindow(QMainWindow):
 
         # declare the existance of a session thread
         self.session_thread = None
+        self.session = None
+
+        # the session recording several mats at once, and the newest live statistics of each of its mats
+        self.multi_mat_session = None
+        self.multi_mat_stats = {}
 
 
     def show_reading_statistics(self, reading: np.ndarray):
@@ -206,6 +288,58 @@ class MainWindow(QMainWindow):
         )
 
 
+    def recalibrate(self):
+        """
+        Asks for a folder of calibration readings, and fits new calibration curves to them off of the GUI thread
+        """
+
+        folder = QFileDialog.getExistingDirectory(self, 'Select folder of calibration readings', './resources/raw_data')
+        if folder == '':
+            return
+
+        readings = load_calibration_readings(folder)
+        if len(readings) < 2:
+            self.recalibration_status.setText("Status: Need at least 2 readings to calibrate")
+            return
+
+        # fit into a separate Calibration, so a running session keeps using the current curves until the fit is done
+        self.new_calibration = Calibration(ROW_WIDTH, COL_HEIGHT, 2)
+        for reading in readings:
+            self.new_calibration.add_reading(reading)
+
+        self.recalibrate_b.setEnabled(False)
+        self.recalibration_status.setText(f"Status: Fitting curves to {len(readings)} readings...")
+
+        self.recalibration_thread = QThread(self)
+        self.recalibration_worker = CalibrationWorker(self.new_calibration, drop_values_greater_than=500)
+        self.recalibration_worker.moveToThread(self.recalibration_thread)
+
+        self.recalibration_thread.started.connect(self.recalibration_worker.run)
+        self.recalibration_worker.finished.connect(self.recalibration_thread.quit)
+        self.recalibration_worker.finished.connect(self.recalibration_worker.deleteLater)
+        self.recalibration_thread.finished.connect(self.recalibration_thread.deleteLater)
+
+        self.recalibration_worker.progress.connect(
+            lambda done, total: self.recalibration_status.setText(f"Status: Fit {done}/{total} sensors with scipy")
+        )
+        self.recalibration_worker.fit_result.connect(self.finish_recalibration)
+
+        self.recalibration_thread.start()
+
+
+    def finish_recalibration(self, min_r2: float, avg_r2: float):
+        """
+        Switches to the newly fit calibration curves
+        """
+
+        self.calibration.set_cal_curves(self.new_calibration.cal_curves_array)
+        self.recalibration_status.setText(f"Status: Recalibrated (R2 min {min_r2:.3f}, avg {avg_r2:.3f})")
+        self.recalibrate_b.setEnabled(True)
+
+        # redraw the loaded session with the new curves
+        self.set_playback_calibration()
+
+
     def start_session(self):
         """
         Starts the data capture session
@@ -213,16 +347,27 @@ class MainWindow(QMainWindow):
 
         print("I will start a mat recording session capped at 1 hour")
 
-        # set up the thread which the session worker will run on
-        self.session_thread = QThread()
+        if self.multi_mat_session is not None:
+            self.session_status.setText("Status: Wait for the running session to stop")
+            return
 
         # load default calibration if the calibrator is uncalibrated
         if not self.calibration.calibrated:
             print("Using default calibration curves")
             self.calibration.load_cal_curves(DEFAULT_CAL_CURVES_PATH)
 
+        ports = [port.strip() for port in self.port_input.text().split(',') if port.strip() != '']
+        if len(ports) > 1:
+            self.start_multi_mat_session(ports)
+            return
+
+        # set up the thread which the session worker will run on
+        self.session_thread = QThread()
+
         # move the session worker onto the thread
-        self.session = SessionWorker(self.port_input.text(), self.baud_input.text(), calibrator=self.calibration)
+        self.session = SessionWorker(self.port_input.text(), self.baud_input.text(), calibrator=self.calibration, 
+                                     record_raw=self.record_raw_cb.isChecked(),
+                                     mode=ACQUISITION_MODE_LATEST if self.latest_frame_cb.isChecked() else ACQUISITION_MODE_LOSSLESS)
         self.session.moveToThread(self.session_thread)
 
         # connect relevant signals
@@ -245,29 +390,146 @@ class MainWindow(QMainWindow):
         self.session_thread.finished.connect(
             lambda: self.session_status.setText("Session stopped")
         )
-        self.session.calculated_pressures.connect(
-            self.render_pressure_array
-        )
-        self.session.session_stats.connect(
-            self.update_session_stats
-        )
         self.session.finished_session_stats.connect(
             self.finish_session_stats
         )
 
+        # frames are drawn by polling the session rather than on every reading, so display can never fall behind
+        self.display_timer.start()
+
+
+    def start_multi_mat_session(self, ports: list):
+        """
+        Starts recording every mat in ports at once, and draws their time aligned frames side by side
+        """
+
+        cal_curves_paths = [path.strip() for path in self.cal_curves_input.text().split(',') if path.strip() != '']
+        if len(cal_curves_paths) not in (0, 1, len(ports)):
+            self.session_status.setText("Status: Give one calibration curves file, or one per port")
+            return
+
+        calibrations = [self.calibration]
+        if cal_curves_paths:
+            calibrations = []
+            for cal_curves_path in cal_curves_paths:
+                calibration = Calibration(ROW_WIDTH, COL_HEIGHT)
+                try:
+                    calibration.load_cal_curves(cal_curves_path)
+                except (OSError, ValueError) as e:
+                    self.session_status.setText(f"Status: Could not load calibration curves {cal_curves_path}: {e}")
+                    return
+                calibrations.append(calibration)
+
+        mats = [MatConfig(port, int(self.baud_input.text()), calibrations[i % len(calibrations)]) for i, port in enumerate(ports)]
+        session = MultiMatSession(mats, record_raw=self.record_raw_cb.isChecked(),
+                                  mode=ACQUISITION_MODE_LATEST if self.latest_frame_cb.isChecked() else ACQUISITION_MODE_LOSSLESS)
+        try:
+            session.start()
+        except ValueError as e:
+            self.session_status.setText(f"Status: {e}")
+            return
+
+        self.multi_mat_session = session
+        self.multi_mat_stats = {}
+        self.session_status.setText(f"Session running with {len(mats)} mats")
+        self.stop_session_b.setEnabled(True)
+
+        # the aligned sets are drawn by polling the session, like the frames of a single mat
+        self.display_timer.start()
+
 
     def stop_session(self):
         """
         Stops the currently running session
         """
         print("I will stop the mat recording session")
-        if self.session:
+        if self.multi_mat_session is not None:
+            self.stop_multi_mat_session()
+        elif self.session:
             self.session.stop()
- 
+
+
+    def stop_multi_mat_session(self):
+        """
+        Asks every mat to stop, without waiting for them as a stalled port could take SERIAL_TIMEOUT_S to give up
+        """
+
+        self.multi_mat_session.request_stop()
+        self.stop_session_b.setEnabled(False)
+        self.session_status.setText("Stopping session...")
+        self.stop_poll_timer.start()
+
+
+    def finish_multi_mat_session(self):
+        """
+        Callback function for the stop poll timer. Once every mat has stopped, adds the overall stats of the session to the GUI
+        """
+
+        if not self.multi_mat_session.stopped():
+            return
+
+        self.stop_poll_timer.stop()
+        self.multi_mat_session.stop()
+
+        # draw the last set, then stop drawing the session
+        self.refresh_live_display()
+        self.display_timer.stop()
+
+        self.session_stats.setText(self.session_stats.text() + '\n' + self.multi_mat_session.summary())
+        self.session_status.setText("Session stopped")
+        self.multi_mat_session = None
+
+
+    def refresh_live_display(self):
+        """
+        Callback function for the display timer. Draws the newest frame of the running session, if there is a new one,
+        and recalculates the reading statistics at most STATS_REFRESH_HZ times per second
+        """
+        if self.multi_mat_session is not None:
+            pressure_array = self.take_multi_mat_set()
+        else:
+            message = self.session.stats_mailbox.take()
+            if message is not None:
+                self.update_session_stats(message)
+
+            pressure_array = self.session.pressures_mailbox.take()
+
+        if pressure_array is None:
+            return
+
+        now = time.monotonic()
+        show_stats = now - self.last_stats_time >= 1 / STATS_REFRESH_HZ
+        if show_stats:
+            self.last_stats_time = now
+
+        self.render_pressure_array(pressure_array, show_stats)
+
+
+    def take_multi_mat_set(self) -> np.ndarray:
+        """
+        Updates the live statistics of every mat of the multi mat session
+        returns: the newest aligned set of frames as one (mats, ROW_WIDTH, COL_HEIGHT) array, with NaN for missing mats,
+                 or None if there is no new set
+        """
+
+        for engine, mat in zip(self.multi_mat_session.engines, self.multi_mat_session.mats):
+            message = engine.stats_mailbox.take()
+            if message is not None:
+                self.multi_mat_stats[mat.name] = message
+
+        if self.multi_mat_stats:
+            self.update_session_stats("\n".join(f"== {name} ==\n{message}" for name, message in self.multi_mat_stats.items()))
+
+        multi_mat_frame = self.multi_mat_session.sets_mailbox.take()
+        if multi_mat_frame is None:
+            return None
+
+        return multi_mat_frame.stacked()
+
 
     def update_session_stats(self, message):
         """
-        Callback function for the session_stats signal of the SessionWorker. Updates the GUI with some live statistics
+        Updates the GUI with some live statistics from the SessionWorker
         """
         self.session_stats.setText(f"Session stats:\n{message}")
 
@@ -276,94 +538,133 @@ class MainWindow(QMainWindow):
         """
         Callback function for the finished_session_stats signal of SessionWorker, adds overall stats to the GUI
         """
-        self.session.session_stats.disconnect()
+        # draw the last frame, then stop drawing the session as the worker is about to be cleaned up
+        self.refresh_live_display()
+        self.display_timer.stop()
         stats_text = self.session_stats.text()
         self.session_stats.setText(stats_text + '\n' + message)
 
 
-    def render_pressure_array(self, pressure_array: np.ndarray):
+    def render_pressure_array(self, pressure_array: np.ndarray, show_stats: bool=True):
         """
-        Converts an array of pressure values to an image based on the saved mat data
+        Converts an array of pressure values to an image based on the saved mat data.
+        A (mats, ROW_WIDTH, COL_HEIGHT) array, eg a set of a multi mat session, is drawn with the mats side by side,
+        and its missing mats (NaN) are drawn at 0 Pa and left out of the stats
         """
         # write the stats of the current reading
-        self.show_reading_statistics(pressure_array)
+        if show_stats:
+            finite_pressures = pressure_array[np.isfinite(pressure_array)]
+            if finite_pressures.size > 0:
+                self.show_reading_statistics(finite_pressures)
+            else:
+                self.mat_stats_label.setText("Mat reading stats:\nNone")
 
-        # convert the raw pressure values to color values
-        scaled_array = (pressure_array / MAX_RATED_PRESSURE_PA)
-        im_array = np.full((ROW_WIDTH, COL_HEIGHT, 3), 255) * scaled_array[..., np.newaxis]
-        im_array = im_array.astype(np.uint8)
+        if pressure_array.ndim == 3:
+            pressure_array = tile_frames(np.nan_to_num(pressure_array), MULTI_MAT_COLUMNS)
 
-        # convert the numpy array directly to an image in memory. See these resources:
-        #   https://stackoverflow.com/questions/34232632/convert-python-opencv-image-numpy-array-to-pyqt-qpixmap-image
-        #   https://copyprogramming.com/howto/pyqt5-convert-2d-np-array-to-qimage
-        image = QImage(im_array.data, im_array.shape[1], im_array.shape[0], QImage.Format.Format_RGB888)
-        self.im_label.setPixmap(QPixmap(image).scaled(self.im_size))
+        # convert the raw pressure values to color values, in a buffer that the renderer reuses for every frame
+        image = self.renderer.render(pressure_array)
+        self.im_label.setPixmap(QPixmap.fromImage(image).scaled(self.im_size, Qt.AspectRatioMode.KeepAspectRatio))
 
 
     def load_past_session(self):
         """
-        Opens the file selector and allows the user to select an npy file from a previous session
+        Opens the file selector and allows the user to select a session file or archive, or an npy file from an older session
         """
         fname = self.getfile()
+        if fname == '':
+            return
 
         self.current_img_path = fname
 
-        new_npy = np.load(fname, allow_pickle=False)
-        self.render_pressure_array(new_npy)
+        if self.playback is not None:
+            self.playback.close()
 
-        # update the slider with the size current session folder
+        # the session is opened once, and its frames are served from a cache while scrubbing
+        self.playback = SessionPlayback(fname)
+        self.set_playback_calibration()
+        if len(self.playback) > 0:
+            self.render_pressure_array(self.playback.get(0))
+
+        # update the slider with the size current session
         self.update_slider()
 
 
-    def get_npy_file_from_slider(self):
+    def set_playback_calibration(self):
         """
-        gets the current slider value, 
-        converts that value to a npy file name (xxxxx.npy), 
-        then renders the .npy file to the screen
+        Chooses the calibration used to play back a raw session: the one it was recorded with, or the current one
         """
+        if self.playback is None or not self.playback.reader.raw:
+            return
 
-        # convert slider value to string with padded zeros and .npy extension
-        next_npy_file = f"{self.slider.value():05}"
-        next_npy_file = next_npy_file + ".npy"
+        snapshot = self.playback.reader.calibration_snapshot()
+        if self.recalibrate_playback_cb.isChecked() or snapshot is None:
+            self.playback.set_calibrator(self.calibration)
+        else:
+            recorded_calibration = Calibration(ROW_WIDTH, COL_HEIGHT)
+            recorded_calibration.load_snapshot(snapshot)
+            self.playback.set_calibrator(recorded_calibration)
 
-        # converts current_img_path to path type to get the parent directory and then find the next npy file in that directory, then converts back to string
-        self.current_img_path = str((Path(self.current_img_path).parents[0]).joinpath(Path(next_npy_file)))
+        # redraw the current frame with the new calibration
+        if len(self.playback) > 0:
+            self.render_pressure_array(self.playback.get(self.slider.value()))
 
-        new_npy = np.load(self.current_img_path, allow_pickle=False)
 
-        self.render_pressure_array(new_npy)
+    def get_npy_file_from_slider(self):
+        """
+        gets the current slider value and renders that frame of the loaded session to the screen
+        """
 
+        if self.playback is None:
+            return
 
-    def update_slider(self):
+        self.render_pressure_array(self.playback.get(self.slider.value()))
+
+        if self.playback.has_time_index():
+            self.seek_time_input.setValue(self.playback.time_offset_s(self.slider.value()))
+
+
+    def seek_to_time(self):
         """
-        sets the maximum value of the slider based on how many images are in the session and sets slider position to zero
+        moves the slider to the frame at the time entered in the seek box
         """
 
-        self.slider.setMaximum(self.count_files_in_folder(Path(self.current_img_path).parents[0])-1)
-        self.slider.setValue(0)
+        if self.playback is None or not self.playback.has_time_index() or len(self.playback) == 0:
+            return
+
+        # the box shows the current frame's time rounded to its decimals, so leaving it unchanged must not move the slider
+        current_offset_s = round(self.playback.time_offset_s(self.slider.value()), self.seek_time_input.decimals())
+        if self.seek_time_input.value() == current_offset_s:
+            return
+
+        self.slider.setValue(self.playback.seek_time(self.seek_time_input.value()))
 
 
-    def count_files_in_folder(self, dir_path):
+    def update_slider(self):
         """
-        Used to count the number of files in a folder. From https://pynative.com/python-count-number-of-files-in-a-directory/
+        sets the maximum value of the slider based on how many images are in the session and sets slider position to zero
         """
 
-        count = 0
-        # Iterate directory
-        for path in os.listdir(dir_path):
-            # check if current path is a file
-            if os.path.isfile(os.path.join(dir_path, path)):
-                count += 1
+        self.slider.setMaximum(max(len(self.playback) - 1, 0))
 
-        return count
+        # only sessions recorded with timestamps can be navigated by time
+        seekable = self.playback.has_time_index() and len(self.playback) > 0
+        self.seek_time_input.setEnabled(seekable)
+        self.seek_time_input.setRange(0, self.playback.time_offset_s(len(self.playback) - 1) if seekable else 0)
+
+        self.slider.setValue(0)
 
 
     def closeEvent(self, event):
         """
         Called when the window is closed. Exit the application
         """
-    
-        self.stop_session()
+
+        # the window is going away, so wait for every mat's session to be written out before the threads are killed
+        if self.multi_mat_session is not None:
+            self.multi_mat_session.stop()
+        else:
+            self.stop_session()
 
 
     def getfile(self):
@@ -0,0 +1,542 @@
+"""
+Module responsible for acquiring frames from the PMI: reading them from serial, decoding, calibrating and saving them.
+Nothing in here depends on Qt, so sessions can be recorded on machines without a display (see record_session.py).
+The GUI drives the same engine through the thin QObject workers in communicator.py
+"""
+
+from datetime import datetime
+import json, time, threading
+
+from pathlib import Path
+
+import serial
+import serial.tools.list_ports
+
+import numpy as np
+
+from modules.calibration import Calibration, MatReading, MAX_RATED_PRESSURE_PA
+from modules.frame_parser import FrameParser
+from modules.mat_handler import *
+from modules.session_file import SessionWriter, BackgroundSessionWriter, SESSION_FILE_NAME, WRITE_QUEUE_SIZE, WRITE_POLICY_BLOCK
+from modules.session_stats import LatencyHistogram, IntervalStats, format_stage_latencies, save_stage_latencies
+
+SESSIONS_FOLDER = "sessions"     # default folder new session folders are created in, relative to the working directory
+SERIAL_TIMEOUT_S = 10
+FRAME_FORMAT_TIMEOUT_S = 0.5    # how long to wait for the PMI to acknowledge a frame format before falling back to legacy frames
+LIVE_STATS_INTERVAL_S = 0.1     # minimum time between formatting live statistics, which costs far more than a frame
+SERIAL_BITS_PER_BYTE = 10       # start bit, 8 data bits and stop bit, to estimate how long bytes took to arrive
+
+# how frames are handled when the host falls behind the PMI
+ACQUISITION_MODE_LOSSLESS = "lossless"  # process and record every frame, however far behind that puts the display
+ACQUISITION_MODE_LATEST = "latest"      # drain the backlog and process only the newest frame, for bounded latency
+ACQUISITION_MODES = (ACQUISITION_MODE_LOSSLESS, ACQUISITION_MODE_LATEST)
+
+# serial receive buffer sizes requested from the OS (only the windows driver lets them be set). Lossless sessions need
+# room for a long stall, and latest frame sessions only need room for the frames they drain each read
+LOSSLESS_RX_BUFFER_SIZE = FRAME_SIZE * 256
+LATEST_RX_BUFFER_SIZE = FRAME_SIZE * 8
+TX_BUFFER_SIZE = 1700
+
+# the stages of the acquisition loop which are timed. serial_wait and verify are timed once per read from serial,
+# and the rest once per frame
+LATENCY_STAGES = ("serial_wait", "verify", "decode", "calibrate", "offset", "save", "emit")
+LATENCY_FILE_NAME = "stage_latencies.json"  # the histograms of every stage are written to this file in the session folder
+LINK_STATS_FILE_NAME = "link_stats.json"    # the frame format and counts of lost, corrupted and skipped frames are written to this file
+
+
+def create_session_folder(sessions_folder=SESSIONS_FOLDER) -> Path:
+    """
+    Creates a folder for a new session inside sessions_folder, named after the current time in the format yy_mm_dd_THH_MM_SS_i
+    returns: the path of the new folder
+    """
+
+    folder_name = datetime.now().strftime("%y_%m_%d_T%H_%M_%S")
+    Path(sessions_folder).mkdir(parents=True, exist_ok=True)
+
+    i = 0
+    while(True):
+        # attempt to create the folder, and increment its number by one if the creation fails
+        try:
+            path = Path(sessions_folder).joinpath(f"{folder_name}_{i}")
+            path.mkdir()
+            return path
+        except FileExistsError as e:
+            i += 1
+
+
+def port_exists(port: str) -> bool:
+    """
+    Returns True if port is one of the serial ports on this machine. Ports which are not listed but exist as a device
+    file, such as ptys, are accepted too
+    """
+    return port in [tuple(p)[0] for p in serial.tools.list_ports.comports()] or Path(port).exists()
+
+
+def negotiate_frame_format(ser: serial.Serial, frame_format: int=FRAME_FORMAT_CHECKED, timeout: float=FRAME_FORMAT_TIMEOUT_S) -> int:
+    """
+    Asks the PMI to stream frames in frame_format once START_READING_COMMAND is sent. Boards which do not support the
+    format (or the command) answer with something other than the echoed command, or nothing at all.
+    If the echo does not arrive, the PMI is asked for legacy frames, so a board which accepted the format late does not
+    stream frames the host would parse as legacy ones
+    returns: frame_format if the PMI acknowledged it, otherwise FRAME_FORMAT_LEGACY
+    """
+
+    if frame_format == FRAME_FORMAT_LEGACY:
+        return FRAME_FORMAT_LEGACY
+
+    # anything already waiting, eg the reply to an earlier command, would otherwise be taken for the answer
+    ser.reset_input_buffer()
+
+    if request_frame_format(ser, frame_format, timeout):
+        return frame_format
+
+    print(f"PMI does not support frame format {frame_format}, using legacy frames")
+    request_frame_format(ser, FRAME_FORMAT_LEGACY, timeout)
+    return FRAME_FORMAT_LEGACY
+
+
+def request_frame_format(ser: serial.Serial, frame_format: int, timeout: float=FRAME_FORMAT_TIMEOUT_S) -> bool:
+    """
+    Sends FRAME_FORMAT_COMMAND for frame_format, and reads lines until the PMI echoes it or timeout seconds have passed
+    returns: True if the PMI echoed the command
+    """
+
+    command = f"{FRAME_FORMAT_COMMAND} {frame_format}"
+    deadline = time.monotonic() + timeout
+    previous_timeout = ser.timeout
+    try:
+        ser.write((command + '\n').encode('utf-8'))
+
+        # the echo may follow other output, so keep reading lines until it arrives
+        while time.monotonic() < deadline:
+            ser.timeout = max(deadline - time.monotonic(), 0)
+            response = ser.read_until(b'\n')
+            if response.strip() == command.encode('utf-8'):
+                return True
+            if not response.endswith(b'\n'):
+                # timed out part way through a line
+                break
+    finally:
+        ser.timeout = previous_timeout
+
+    return False
+
+
+def read_single_frame(port: str, baud: int, timeout: float=SERIAL_TIMEOUT_S) -> np.ndarray:
+    """
+    Asks the PMI for a single reading of the mat and decodes the frame it sends back
+    returns: the (ROW_WIDTH, COL_HEIGHT) array of uint8 readings, or None if serial timed out
+    """
+
+    with serial.Serial(port=port, baudrate=baud, timeout=timeout) as ser:
+        # request one reading from the mat, which unlike START_READING_COMMAND leaves the board waiting for commands
+        ser.write((GET_CAL_VALS_COMMAND + '\n').encode('utf-8'))
+
+        # read the mat's response
+        frame = ser.read(FRAME_SIZE)
+        if len(frame) < FRAME_SIZE:
+            print("Serial timed out!")
+            return None
+
+        # ensure that the verifiation message was aligned
+        if not frame_is_aligned(frame):
+            raise Exception("Verification sequence not found in mat transmission")
+
+        return decode_mat_frame(frame)
+
+
+def sample_mat_reading(port: str, baud: int, calibration_weight: float) -> MatReading:
+    """
+    Reads one frame from the mat as a MatReading for the weight calibration_weight (in lbs), or None if serial timed out
+    """
+
+    mat_vals = read_single_frame(port, baud)
+    if mat_vals is None:
+        return None
+    return MatReading(ROW_WIDTH, COL_HEIGHT, calibration_weight, mat_vals)
+
+
+class FrameMailbox:
+    """
+    Single slot mailbox which hands the newest item from a producer thread to a consumer thread.
+    Publishing replaces any item that has not been taken yet, so a slow consumer only ever sees the latest item
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.item = None
+        self.published = 0
+        self.overwritten = 0    # number of items replaced before they were taken
+
+
+    def publish(self, item):
+        """
+        Puts an item in the mailbox, replacing any item that has not been taken
+        """
+
+        with self.lock:
+            if self.item is not None:
+                self.overwritten += 1
+            self.item = item
+            self.published += 1
+
+
+    def take(self):
+        """
+        Removes and returns the newest item, or None if nothing has been published since the last take
+        """
+
+        with self.lock:
+            item, self.item = self.item, None
+        return item
+
+
+    def pending(self) -> bool:
+        """
+        Returns True if there is an item waiting to be taken
+        """
+        return self.item is not None
+
+
+class AcquisitionEngine:
+    """
+    Class which records a session from the PMI without any GUI. run() blocks until stop() is called from another thread
+    (or a signal handler), and the caller is told about the session through optional callbacks, which run on the
+    thread that called run() so they should be quick:
+        on_frame(data_array, pressure_array, arrival_ns)    every decoded frame, as raw readings and as calibrated pressures,
+                                                            and the time.monotonic_ns() its last byte arrived (see receive())
+        on_stats(message)                                   live statistics, at most once every stats_interval_s
+    The newest pressures and statistics are also published to pressures_mailbox and stats_mailbox, for consumers
+    which would rather poll at their own rate.
+    The PMI is asked for frame_format frames, and legacy frames are used if it does not support them. Only checked frames
+    let lost and corrupted frames be counted.
+    In ACQUISITION_MODE_LOSSLESS every frame is processed and recorded. In ACQUISITION_MODE_LATEST only the newest frame
+    of each read is, and the older frames are counted in frames_skipped, so a slow host falls behind by at most one read
+    """
+
+    def __init__(self, port: str, baud: int, calibrator: Calibration, path=None, write_queue_size: int=WRITE_QUEUE_SIZE,
+                 write_policy: str=WRITE_POLICY_BLOCK, record_raw: bool=False, on_frame=None, on_stats=None,
+                 stats_interval_s: float=LIVE_STATS_INTERVAL_S, mode: str=ACQUISITION_MODE_LOSSLESS,
+                 frame_format: int=FRAME_FORMAT_CHECKED):
+        if mode not in ACQUISITION_MODES:
+            raise ValueError(f"Unknown acquisition mode {mode}, expected one of {ACQUISITION_MODES}")
+
+        self.path = Path(path) if path is not None else create_session_folder()
+        self.port = port
+        self.baud = int(baud)
+        self.polling = False
+        self.calibrator = calibrator
+        self.session_file = None
+        self.write_queue_size = write_queue_size
+        self.write_policy = write_policy
+        self.record_raw = record_raw    # record the uint8 readings and calibration instead of calibrated pressures
+        self.on_frame = on_frame
+        self.on_stats = on_stats
+        self.stats_interval_ns = stats_interval_s * 1000000000
+        self.mode = mode
+        self.requested_frame_format = frame_format
+        self.frame_format = None    # the format the PMI agreed to, once streaming has started
+
+        # variables used to track statistics about the session
+        self.start_time_ns = time.time_ns()
+        self.start_monotonic_ns = time.monotonic_ns()   # the time index's clock at start_time_ns, to convert it to wall clock time
+        self.intervals = IntervalStats()
+        self.transmission_errors = 0
+        self.frames_skipped = 0     # frames left unprocessed in latest frame mode
+        self.parser = FrameParser()
+        self.last_stats_ns = 0
+        self.prev_sample_time_ns = None
+        self.last_arrival_ns = 0    # arrival time of the newest frame, which no later frame may arrive before
+        self.stage_latencies = {stage: LatencyHistogram() for stage in LATENCY_STAGES}
+        self.serial = None
+
+        # the newest pressure array and live formatted statistics
+        self.pressures_mailbox = FrameMailbox()
+        self.stats_mailbox = FrameMailbox()
+
+        # running per sensor mean, variance, min and max over the session, eg for noise and drift maps
+        self.sensor_stats = SensorRunningStats((ROW_WIDTH, COL_HEIGHT))
+
+
+    def run(self) -> bool:
+        """
+        Records frames until stop() is called
+        returns: False if the port does not exist, otherwise True once the session has been written out
+        """
+
+        # exit if the port does not exist
+        if not port_exists(self.port):
+            print("Port does not exist")
+            return False
+
+        self.open_session_file()
+
+        print("opening serial")
+        try:
+            # connect to the PMI
+            with serial.Serial(self.port, baudrate=self.baud, timeout=SERIAL_TIMEOUT_S) as ser:
+                self.start_streaming(ser)
+
+                # continually poll serial for new mat data
+                while self.polling:
+                    # mat data is transmitted as raw bytes. Read everything that is waiting, or at least enough to finish a frame
+                    wait_start_ns = time.perf_counter_ns()
+                    data = ser.read(self.parser.read_size(ser.in_waiting))
+                    arrival_ns = time.monotonic_ns()
+                    self.stage_latencies["serial_wait"].record(time.perf_counter_ns() - wait_start_ns)
+
+                    if data == b'':
+                        print("Serial timed out!")
+                        continue
+
+                    for frame, frame_arrival_ns in self.receive(data, arrival_ns):
+                        self.process_frame(frame, frame_arrival_ns)
+        finally:
+            self.close_session_file()
+
+        return True
+
+
+    def start_streaming(self, ser: serial.Serial):
+        """
+        Tells the PMI on the open serial port to start streaming frames
+        """
+
+        self.serial = ser
+
+        # only the windows serial driver lets the buffer size be set
+        if hasattr(ser, "set_buffer_size"):
+            rx_size = LATEST_RX_BUFFER_SIZE if self.mode == ACQUISITION_MODE_LATEST else LOSSLESS_RX_BUFFER_SIZE
+            ser.set_buffer_size(rx_size = rx_size, tx_size = TX_BUFFER_SIZE)
+
+        # agree on the frame format before the board starts streaming and stops listening for commands
+        self.frame_format = negotiate_frame_format(ser, self.requested_frame_format)
+        self.parser = FrameParser(self.frame_format)
+
+        # send the message to start reading the mat
+        ser.write((START_READING_COMMAND + '\n').encode('utf-8'))
+        self.polling = True
+
+        self.prev_sample_time_ns = time.time_ns()
+
+
+    def open_session_file(self):
+        """
+        Creates the session file that every frame of the session is appended to
+        """
+
+        # frames are written from a separate thread so disk writes can not stall serial
+        writer = SessionWriter(self.path.joinpath(SESSION_FILE_NAME), (ROW_WIDTH, COL_HEIGHT),
+                               np.uint8 if self.record_raw else np.float64, metadata=self.session_metadata(), timestamps=True)
+        self.session_file = BackgroundSessionWriter(writer, self.write_queue_size, self.write_policy)
+
+
+    def close_session_file(self):
+        """
+        Writes out where the time went, how many frames were lost and every frame that is still queued, and closes the session file
+        """
+
+        try:
+            save_stage_latencies({**self.stage_latencies, "frame_interval": self.intervals.histogram},
+                                 self.path.joinpath(LATENCY_FILE_NAME))
+            with open(self.path.joinpath(LINK_STATS_FILE_NAME), "w") as f:
+                json.dump(self.link_stats(), f, indent=4)
+        finally:
+            self.session_file.close()
+
+
+    def receive(self, data: bytes, arrival_ns: int) -> list:
+        """
+        Splits bytes read from serial at arrival_ns into frames, checking that each one ends with the verification sequence.
+        A read can hold several frames, so each one is back-dated by the time the bytes after it took to arrive at the
+        baud rate, without going back past the frame before it
+        returns: the list of (frame, arrival_ns) of the complete, aligned frames to process, which in latest frame mode
+                 is only the newest one
+        """
+
+        verify_start_ns = time.perf_counter_ns()
+        self.parser.feed(data)
+        frames = [(frame, self.parser.buffered()) for frame in self.parser.frames()]
+        self.stage_latencies["verify"].record(time.perf_counter_ns() - verify_start_ns)
+
+        # a verification error has occured, probably because the fifo filled up. The parser resyncs on its own
+        if self.parser.resyncs > self.transmission_errors:
+            self.transmission_errors = self.parser.resyncs
+            print("====TRANSMISSION ERROR OCCURED! FIXING!!!====")
+
+        if self.mode == ACQUISITION_MODE_LATEST and len(frames) > 1:
+            self.frames_skipped += len(frames) - 1
+            frames = frames[-1:]
+
+        byte_time_ns = SERIAL_BITS_PER_BYTE * 1000000000 / self.baud
+        timed_frames = []
+        for frame, bytes_after in frames:
+            self.last_arrival_ns = max(arrival_ns - int(bytes_after * byte_time_ns), self.last_arrival_ns)
+            timed_frames.append((frame, self.last_arrival_ns))
+
+        return timed_frames
+
+
+    def process_frame(self, frame: bytes, arrival_ns: int):
+        """
+        Decodes, calibrates and saves one aligned frame, then hands it to the consumers, timing each stage
+        """
+
+        start_ns = time.perf_counter_ns()
+        data_array = decode_mat_frame(frame)
+        decoded_ns = time.perf_counter_ns()
+
+        pressure_array = self.calibrator.apply_calibration_curve(data_array)
+        calibrated_ns = time.perf_counter_ns()
+        pressure_array = self.calibrator.apply_dc_offsets(pressure_array)
+        offset_ns = time.perf_counter_ns()
+
+        # save the raw readings or pressure values to the session file
+        self.save_frame(data_array if self.record_raw else pressure_array, arrival_ns)
+        saved_ns = time.perf_counter_ns()
+
+        self.pressures_mailbox.publish(pressure_array)
+        self.sensor_stats.update(pressure_array)
+
+        if self.on_frame is not None:
+            self.on_frame(data_array, pressure_array, arrival_ns)
+
+        # update the timing statistics
+        now_ns = time.time_ns()
+        self.intervals.record(now_ns - self.prev_sample_time_ns)
+        self.prev_sample_time_ns = now_ns
+
+        if now_ns - self.last_stats_ns >= self.stats_interval_ns:
+            self.last_stats_ns = now_ns
+            self.publish_stats()
+
+        emitted_ns = time.perf_counter_ns()
+
+        self.stage_latencies["decode"].record(decoded_ns - start_ns)
+        self.stage_latencies["calibrate"].record(calibrated_ns - decoded_ns)
+        self.stage_latencies["offset"].record(offset_ns - calibrated_ns)
+        self.stage_latencies["save"].record(saved_ns - offset_ns)
+        self.stage_latencies["emit"].record(emitted_ns - saved_ns)
+
+
+    def publish_stats(self):
+        """
+        Formats the live statistics of the session and hands them to the consumers
+        """
+
+        msg = f"{self.rate_label()}: {self.intervals.recent_rate_hz():.2f}Hz\nQueued RX size: {self.serial.in_waiting}\n"
+        msg += f"Total session time: {((time.time_ns() - self.start_time_ns) / 1000000000):.2f}s\n"
+        msg += f"Transmission errors: {self.parser.resyncs} ({self.parser.discarded_bytes} bytes discarded)\n"
+        if self.frame_format == FRAME_FORMAT_CHECKED:
+            msg += f"Frames lost/corrupted: {self.parser.frames_lost}/{self.parser.corrupt_frames}\n"
+        msg += f"Frames not displayed: {self.pressures_mailbox.overwritten}\n"
+        if self.mode == ACQUISITION_MODE_LATEST:
+            msg += f"Frames skipped: {self.frames_skipped}\n"
+        msg += f"Max sensor noise (std dev): {np.max(self.sensor_stats.std()):.3f}Pa\n"
+        msg += self.format_write_stats()
+        msg += format_stage_latencies(self.stage_latencies)
+
+        self.stats_mailbox.publish(msg)
+        if self.on_stats is not None:
+            self.on_stats(msg)
+
+
+    def rate_label(self) -> str:
+        """
+        Returns what the rate measured by intervals is. In latest frame mode only the processed frames are timed, so it
+        is the processed frame rate, which falls below the rate the PMI sends at whenever frames are skipped
+        """
+        return "Processed frame rate" if self.mode == ACQUISITION_MODE_LATEST else "Sample rate"
+
+
+    def stop(self):
+        """
+        Asks run() to finish the session after the frames it is currently reading
+        """
+
+        print('stopping')
+        self.polling = False
+
+
+    def summary(self) -> str:
+        """
+        Returns the overall statistics of the session as a formatted string
+        """
+
+        msg = f"Average {self.rate_label().lower()}: {self.intervals.rate_hz():02f}Hz\n"
+        msg += f"Total # transmission errors: {self.transmission_errors}\n"
+        msg += f"Total bytes discarded resyncing: {self.parser.discarded_bytes}\n"
+        if self.frame_format == FRAME_FORMAT_CHECKED:
+            msg += f"Total frames lost/corrupted: {self.parser.frames_lost}/{self.parser.corrupt_frames}\n"
+        elif self.frame_format == FRAME_FORMAT_LEGACY:
+            msg += "Legacy frame format: lost and corrupted frames can not be counted\n"
+        if self.mode == ACQUISITION_MODE_LATEST:
+            msg += f"Total frames skipped: {self.frames_skipped}\n"
+        if self.session_file is not None:
+            msg += self.format_write_stats()
+        msg += format_stage_latencies(self.stage_latencies)
+
+        return msg
+
+
+    def save_frame(self, pressure_array: np.ndarray, arrival_ns: int):
+        """
+        Queues an array of pressure values (or raw readings) to be appended to the session file, along with the time it arrived
+        """
+
+        self.session_file.append(pressure_array, arrival_ns)
+
+
+    def link_stats(self) -> dict:
+        """
+        Returns the frame format of the session and how many frames were lost, corrupted or skipped on the way in
+        """
+
+        return {
+            "frame_format": self.frame_format,
+            "frames_parsed": self.parser.frames_parsed,
+            "frames_lost": self.parser.frames_lost if self.frame_format == FRAME_FORMAT_CHECKED else None,
+            "corrupt_frames": self.parser.corrupt_frames if self.frame_format == FRAME_FORMAT_CHECKED else None,
+            "resyncs": self.parser.resyncs,
+            "discarded_bytes": self.parser.discarded_bytes,
+            "frames_skipped": self.frames_skipped,
+        }
+
+
+    def format_write_stats(self) -> str:
+        """
+        Returns the statistics of the session file's write queue as a formatted string
+        """
+
+        stats = self.session_file.stats()
+        msg = f"Write queue depth: {stats['queue_depth']} (max {stats['max_queue_depth']})\n"
+        msg += f"Frames dropped/spilled by writer: {stats['frames_dropped']}/{stats['frames_spilled']}\n"
+        return msg
+
+
+    def session_metadata(self) -> dict:
+        """
+        Returns information about the session to store in the header of the session file
+        """
+
+        metadata = {
+            "port": self.port,
+            "baud": self.baud,
+            "start_time_ns": self.start_time_ns,
+            "start_monotonic_ns": self.start_monotonic_ns,
+            "units": "raw" if self.record_raw else "Pa",
+            "calibrated": self.calibrator is not None and self.calibrator.calibrated,
+            "max_rated_pressure_pa": MAX_RATED_PRESSURE_PA,
+            "raw": self.record_raw,
+            "mode": self.mode,
+        }
+
+        # raw sessions are calibrated when they are played back, so they need the calibration that was active
+        if self.record_raw and self.calibrator is not None:
+            metadata["calibration"] = self.calibrator.snapshot()
+
+        return metadata
+
+
+    def __str__(self):
+        return f"Session at {self.port=}, {self.baud=}, {self.mode=}"
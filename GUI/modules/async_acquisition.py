@@ -0,0 +1,239 @@
+"""
+Module responsible for acquiring frames from many PMIs on a single thread with asyncio, instead of one blocking
+AcquisitionEngine.run() thread per mat. Each mat still has its own AcquisitionEngine, which does the parsing,
+verification, calibration and saving; this module only replaces the blocking serial reads.
+On POSIX systems the serial ports are read without blocking whenever the event loop reports their file descriptors
+readable. Windows event loops can not watch serial ports, so there each read is handed to the loop's executor instead
+"""
+
+import asyncio, os, threading, time
+
+import serial
+
+from modules.acquisition import *
+
+ASYNC_MAX_PENDING_FRAMES = 8    # frames of a mat which may wait to be processed before its port stops being read
+ASYNC_NONBLOCKING_IO = os.name == "posix"
+
+
+class AsyncPortReader:
+    """
+    Class which drives an AcquisitionEngine from an asyncio event loop. One task reads bytes from the port and splits them
+    into frames, and another processes the frames. At most max_pending_frames frames wait between the two: once that
+    many are waiting the port is not read, so the backlog builds up in the serial driver and the board instead of in memory.
+    If nothing arrives for timeout_s the timeout is counted and reading carries on, without holding up any other port.
+    In latest frame mode a new frame replaces any that are waiting, so the port is always read.
+    Cancelling run() stops the session cleanly, processing the frames that were already read and closing the session file.
+    If processing a frame fails, reading stops and run() raises the exception once the session file is closed
+    """
+
+    def __init__(self, engine: AcquisitionEngine, timeout_s: float=SERIAL_TIMEOUT_S,
+                 max_pending_frames: int=ASYNC_MAX_PENDING_FRAMES):
+        self.engine = engine
+        self.timeout_s = timeout_s
+        self.max_pending_frames = max_pending_frames
+        self.pending = None
+
+        # statistics about the reader
+        self.timeouts = 0
+        self.backpressure_waits = 0     # number of times the port stopped being read because frames were waiting
+
+
+    async def run(self) -> bool:
+        """
+        Records frames until the engine is stopped or the task is cancelled
+        returns: False if the port does not exist, otherwise True once the session has been written out
+        """
+
+        if not port_exists(self.engine.port):
+            print("Port does not exist")
+            return False
+
+        self.engine.open_session_file()
+        self.pending = asyncio.Queue(self.max_pending_frames)
+
+        print("opening serial")
+        try:
+            # a timeout of 0 makes reads return whatever is waiting instead of blocking the event loop
+            with serial.Serial(self.engine.port, baudrate=self.engine.baud,
+                               timeout=0 if ASYNC_NONBLOCKING_IO else self.timeout_s) as ser:
+                # agreeing on the frame format waits for the board to answer, so it is done off of the event loop
+                await asyncio.get_running_loop().run_in_executor(None, self.engine.start_streaming, ser)
+
+                reader = asyncio.create_task(self.read_loop(ser))
+                processor = asyncio.create_task(self.process_loop())
+                try:
+                    # stop at the first failure of either task, as the reader could otherwise wait forever on a full queue
+                    await asyncio.wait({reader, processor}, return_when=asyncio.FIRST_EXCEPTION)
+
+                    # raise the failure, like an exception from process_frame() or a serial read in AcquisitionEngine.run()
+                    for task in (processor, reader):
+                        if task.done() and task.exception() is not None:
+                            raise task.exception()
+                finally:
+                    processor_failed = processor.done() and not processor.cancelled() and processor.exception() is not None
+                    reader.cancel()
+                    processor.cancel()
+
+                    # let the tasks finish cancelling while the port is still open, as the reader stops watching it on the way out
+                    await asyncio.gather(reader, processor, return_exceptions=True)
+
+                    # process the frames which were read before the session was stopped or cancelled, unless processing failed
+                    while not processor_failed and not self.pending.empty():
+                        item = self.pending.get_nowait()
+                        if item is not None:
+                            self.engine.process_frame(*item)
+        finally:
+            self.engine.close_session_file()
+
+        return True
+
+
+    async def read_loop(self, ser: serial.Serial):
+        """
+        Reads bytes from the port and queues every complete frame until the engine is stopped, then queues None
+        """
+
+        while self.engine.polling:
+            wait_start_ns = time.perf_counter_ns()
+            data = await self.read(ser)
+            arrival_ns = time.monotonic_ns()
+            self.engine.stage_latencies["serial_wait"].record(time.perf_counter_ns() - wait_start_ns)
+
+            if data == b'':
+                self.timeouts += 1
+                print(f"Serial timed out on {self.engine.port}!")
+                continue
+
+            for item in self.engine.receive(data, arrival_ns):
+                # in latest frame mode, a newer frame replaces any that are still waiting instead of waiting behind them
+                if self.engine.mode == ACQUISITION_MODE_LATEST:
+                    while not self.pending.empty():
+                        self.pending.get_nowait()
+                        self.engine.frames_skipped += 1
+
+                if self.pending.full():
+                    self.backpressure_waits += 1
+                await self.pending.put(item)
+
+        await self.pending.put(None)
+
+
+    async def process_loop(self):
+        """
+        Processes queued frames until the read loop queues None
+        """
+
+        while True:
+            item = await self.pending.get()
+            if item is None:
+                return
+
+            self.engine.process_frame(*item)
+
+            # give the other ports a turn after every frame
+            await asyncio.sleep(0)
+
+
+    async def read(self, ser: serial.Serial) -> bytes:
+        """
+        Waits up to timeout_s for bytes to arrive without blocking the event loop
+        returns: everything that is waiting, or at least enough to finish a frame on windows, or b'' on a timeout
+        """
+
+        loop = asyncio.get_running_loop()
+        read_size = self.engine.parser.read_size(ser.in_waiting)
+
+        if not ASYNC_NONBLOCKING_IO:
+            return await loop.run_in_executor(None, ser.read, read_size)
+
+        data = ser.read(read_size)
+        if data:
+            return data
+
+        # nothing is waiting, so sleep until the port's file descriptor becomes readable
+        readable = loop.create_future()
+        loop.add_reader(ser.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, self.timeout_s)
+        except asyncio.TimeoutError:
+            return b''
+        finally:
+            loop.remove_reader(ser.fileno())
+
+        return ser.read(self.engine.parser.read_size(ser.in_waiting))
+
+
+    def stats(self) -> str:
+        """
+        Returns the statistics of the reader as a formatted string
+        """
+        return f"Serial timeouts: {self.timeouts}\nReads held back by unprocessed frames: {self.backpressure_waits}\n"
+
+
+class AsyncAcquisitionLoop:
+    """
+    Class which runs the AsyncPortReaders of several engines on one event loop, on a single background thread.
+    stop() may be called from any thread
+    """
+
+    def __init__(self, engines: list, timeout_s: float=SERIAL_TIMEOUT_S, max_pending_frames: int=ASYNC_MAX_PENDING_FRAMES):
+        self.readers = [AsyncPortReader(engine, timeout_s, max_pending_frames) for engine in engines]
+        self.loop = None
+        self.tasks = []
+        self.results = []
+        self.started = threading.Event()
+        self.thread = None
+
+
+    def start(self):
+        """
+        Starts reading every port on the event loop thread
+        """
+
+        self.thread = threading.Thread(target=asyncio.run, args=(self.main(),), name="AsyncAcquisitionThread", daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+
+    async def main(self):
+        """
+        Runs every reader until they have all finished
+        """
+
+        self.loop = asyncio.get_running_loop()
+        self.tasks = [asyncio.create_task(reader.run()) for reader in self.readers]
+        self.started.set()
+
+        # a reader which fails or is cancelled does not stop the others
+        self.results = await asyncio.gather(*self.tasks, return_exceptions=True)
+        for reader, result in zip(self.readers, self.results):
+            if isinstance(result, Exception):
+                print(f"Reading {reader.engine.port} failed: {result!r}")
+
+
+    def request_stop(self):
+        """
+        Cancels every reader without waiting for their sessions to be written out
+        """
+
+        for reader in self.readers:
+            reader.engine.stop()
+        for task in self.tasks:
+            self.loop.call_soon_threadsafe(task.cancel)
+
+
+    def stopped(self) -> bool:
+        """
+        Returns True once every reader has finished and written out its session
+        """
+        return not self.thread.is_alive()
+
+
+    def stop(self):
+        """
+        Cancels every reader, and waits for their sessions to be written out
+        """
+
+        self.request_stop()
+        self.thread.join()
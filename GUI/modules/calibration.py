@@ -2,14 +2,13 @@
 Module responsible for handling the calibration of the mat
 """
 
-import numpy as np
-import scipy
-from scipy.optimize import Bounds
-from numpy.polynomial.polynomial import Polynomial
+import os
+from pathlib import Path
 
-from PyQt6.QtCore import QObject, pyqtSignal
+import numpy as np
 
-import serial
+# scipy and the process pool are only needed when fitting curves, so they are imported by the functions that fit.
+# This keeps them out of the startup of the GUI and of headless recording, which only apply existing curves
 
 from modules.mat_handler import *
 
@@ -19,7 +18,187 @@ DEFAULT_CAL_CURVES_PATH = "./resources/default_calibration_curves.npy"
 AVERAGED_CAL_CURVES_PATH = "./resources/averaged_calibration_curves.npy"
 
 CAL_CURVE_P0 = [0.05, 0.05, 100]    # initial parameters for calibration curve fitting routine
-CAL_CURVE_BOUNDS = Bounds([0.00001, 0.00001, 0], [100, 10, 500])    # bound for cal curve fitting routine
+CAL_CURVE_BOUNDS = ([0.00001, 0.00001, 0], [100, 10, 500])    # (lower, upper) bounds for cal curve fitting routine
+
+CAL_FIT_CHUNK_SIZE = 64     # number of sensors handed to each worker process when fitting with scipy
+
+CAL_LUT_SIZE = 256  # number of distinct raw values a sensor can report (readings are transmitted as uint8)
+
+
+def fit_exponential_curves(x_vals: np.ndarray, y_vals: np.ndarray, valid: np.ndarray, bounds: tuple=CAL_CURVE_BOUNDS, 
+                           grid_size: int=128, iterations: int=64):
+    """
+    Fits a * exp(b * x) + c to every sensor at once using stacked numpy arrays.
+    x_vals is (sensors, samples), y_vals is (samples,) or (sensors, samples), and samples where valid is False are ignored.
+    For a fixed b the best bounded a and c have a closed form, so only b is searched for: first on a shared grid, then
+    by a golden section search around the best grid point of each sensor.
+    returns the (sensors, 3) array of [a, b, c] and a mask of the sensors whose fits converged
+    """
+
+    x_vals = np.asarray(x_vals, dtype=np.double)
+    weights = np.asarray(valid, dtype=np.double)
+    y_vals = np.broadcast_to(np.asarray(y_vals, dtype=np.double), x_vals.shape) * weights
+    x_vals = x_vals * weights   # ignored samples are zeroed so that they cannot overflow
+
+    (a_lb, b_lb, c_lb), (a_ub, b_ub, c_ub) = bounds
+
+    # sums over the samples of each sensor which do not depend on b
+    sum_w = np.sum(weights, axis=1)[:, np.newaxis]
+    sum_y = np.sum(y_vals, axis=1)[:, np.newaxis]
+    sum_yy = np.sum(np.square(y_vals), axis=1)[:, np.newaxis]
+
+    def solve_a_c(b: np.ndarray):
+        """
+        For a (sensors, k) array of b values, returns the bounded least squares a, c and cost at each of them
+        """
+        u = np.exp(b[..., np.newaxis] * x_vals[:, np.newaxis, :]) * weights[:, np.newaxis, :]
+        sum_u = np.sum(u, axis=2)
+        sum_uu = np.einsum('skn,skn->sk', u, u)
+        sum_uy = np.einsum('skn,sn->sk', u, y_vals)
+
+        def cost(a, c):
+            return sum_yy - 2*a*sum_uy - 2*c*sum_y + a*a*sum_uu + 2*a*c*sum_u + c*c*sum_w
+
+        # the cost is a convex quadratic in (a, c), so its bounded minimum is either the unbounded minimum or lies on an edge
+        det = sum_uu * sum_w - np.square(sum_u)
+        a_free = (sum_uy * sum_w - sum_u * sum_y) / det
+        c_free = (sum_uu * sum_y - sum_u * sum_uy) / det
+        inside = (det > 0) & (a_free >= a_lb) & (a_free <= a_ub) & (c_free >= c_lb) & (c_free <= c_ub)
+
+        candidates = [(np.where(inside, a_free, a_lb), np.where(inside, c_free, c_lb))]
+        for a_edge in (a_lb, a_ub):
+            candidates.append((np.full_like(sum_u, a_edge), np.clip((sum_y - a_edge * sum_u) / sum_w, c_lb, c_ub)))
+        for c_edge in (c_lb, c_ub):
+            candidates.append((np.clip((sum_uy - c_edge * sum_u) / sum_uu, a_lb, a_ub), np.full_like(sum_u, c_edge)))
+
+        best_a, best_c = candidates[0]
+        best_cost = np.where(inside, cost(best_a, best_c), np.inf)
+        for a, c in candidates[1:]:
+            candidate_cost = cost(a, c)
+            better = candidate_cost < best_cost
+            best_a = np.where(better, a, best_a)
+            best_c = np.where(better, c, best_c)
+            best_cost = np.where(better, candidate_cost, best_cost)
+
+        return best_a, best_c, np.where(np.isfinite(best_cost), best_cost, np.inf)
+
+    num_sensors = x_vals.shape[0]
+
+    # exp(b * x) overflows long before b reaches its upper bound, so only search the range that can be represented
+    b_max = min(b_ub, 700 / max(np.max(x_vals), 1))
+
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        # coarse search of b over a shared log spaced grid
+        grid = np.geomspace(b_lb, b_max, grid_size)
+        grid_costs = np.concatenate([solve_a_c(np.broadcast_to(chunk, (num_sensors, len(chunk))))[2] 
+                                     for chunk in np.array_split(grid, max(1, grid_size // 16))], axis=1)
+        best = np.argmin(grid_costs, axis=1)
+
+        # refine b between the neighbours of the best grid point with a golden section search
+        low = grid[np.maximum(best - 1, 0)]
+        high = grid[np.minimum(best + 1, grid_size - 1)]
+        ratio = (np.sqrt(5) - 1) / 2
+        b1 = high - ratio * (high - low)
+        b2 = low + ratio * (high - low)
+        cost1 = solve_a_c(b1[:, np.newaxis])[2][:, 0]
+        cost2 = solve_a_c(b2[:, np.newaxis])[2][:, 0]
+        for _ in range(iterations):
+            left = cost1 < cost2
+            high = np.where(left, b2, high)
+            low = np.where(left, low, b1)
+            b1, b2 = np.where(left, high - ratio * (high - low), b2), np.where(left, b1, low + ratio * (high - low))
+            new_costs = solve_a_c(np.where(left, b1, b2)[:, np.newaxis])[2][:, 0]
+            cost1, cost2 = np.where(left, new_costs, cost2), np.where(left, cost1, new_costs)
+
+        b = (low + high) / 2
+        a, c, cost = (v[:, 0] for v in solve_a_c(b[:, np.newaxis]))
+
+    params = np.stack([a, b, c], axis=1)
+
+    # a fit has only converged if there was enough data for it, and the search did not run into the overflow limit
+    converged = (np.count_nonzero(valid, axis=1) >= 3) & np.isfinite(cost) & np.all(np.isfinite(params), axis=1)
+    converged &= (b_max == b_ub) | (best < grid_size - 1)
+
+    return params, converged
+
+
+def exponential_curve(x: np.array, a, b, c):
+    """
+    The function calibration curves are fit to, usable outside of a Calibration instance (eg by worker processes)
+    """
+    return a * np.exp(b * x) + c
+
+
+def fit_curves_serial(x_vals: np.ndarray, y_vals: np.ndarray, valid: np.ndarray):
+    """
+    Fits each sensor (row) of x_vals individually with scipy's general solver. 
+    returns the (sensors, 3) array of [a, b, c] and a mask of the sensors whose fits converged
+    """
+
+    import scipy.optimize
+
+    params = np.tile(np.asarray(CAL_CURVE_P0, dtype=np.double), (x_vals.shape[0], 1))
+    converged = np.zeros(x_vals.shape[0], dtype=bool)
+    y_vals = np.broadcast_to(y_vals, x_vals.shape)
+
+    for sensor in range(x_vals.shape[0]):
+        x = x_vals[sensor, valid[sensor]]
+        y = y_vals[sensor, valid[sensor]]
+        try:
+            params[sensor], cv = scipy.optimize.curve_fit(exponential_curve, x, y, p0=CAL_CURVE_P0, bounds=CAL_CURVE_BOUNDS, method='trf')
+            converged[sensor] = True
+        except (RuntimeError, ValueError, TypeError) as e:
+            # failed fits and sensors without enough data are left at the default calibration values
+            pass
+
+    return params, converged
+
+
+def fit_curves_parallel(x_vals: np.ndarray, y_vals: np.ndarray, valid: np.ndarray, max_workers: int=None, 
+                        chunk_size: int=CAL_FIT_CHUNK_SIZE, progress_callback=None):
+    """
+    Splits the sensors into chunks and fits them with fit_curves_serial on a process pool sized to the machine.
+    The results are identical to calling fit_curves_serial on every sensor. 
+    progress_callback, if given, is called as progress_callback(sensors_done, total_sensors) as chunks finish
+    """
+
+    num_sensors = x_vals.shape[0]
+    y_vals = np.broadcast_to(y_vals, x_vals.shape)
+    params = np.empty((num_sensors, 3), dtype=np.double)
+    converged = np.zeros(num_sensors, dtype=bool)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    chunks = [slice(start, min(start + chunk_size, num_sensors)) for start in range(0, num_sensors, chunk_size)]
+
+    # there is no point paying for process startup when there is only one worker or one chunk
+    if max_workers <= 1 or len(chunks) <= 1:
+        sensors_done = 0
+        for chunk in chunks:
+            params[chunk], converged[chunk] = fit_curves_serial(x_vals[chunk], y_vals[chunk], valid[chunk])
+            sensors_done += chunk.stop - chunk.start
+            if progress_callback is not None:
+                progress_callback(sensors_done, num_sensors)
+        return params, converged
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    # forking copies the locks held by other threads (eg the GUI's session writer and playback prefetch threads),
+    # which can deadlock the workers, so they are started fresh instead
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(chunks)), mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(fit_curves_serial, x_vals[chunk], y_vals[chunk], valid[chunk]): chunk for chunk in chunks}
+
+        sensors_done = 0
+        for future in as_completed(futures):
+            chunk = futures[future]
+            params[chunk], converged[chunk] = future.result()
+            sensors_done += chunk.stop - chunk.start
+            if progress_callback is not None:
+                progress_callback(sensors_done, num_sensors)
+
+    return params, converged
 
 
 class MatReading:
@@ -37,6 +216,22 @@ class MatReading:
 
 
 
+def load_calibration_readings(folder) -> list:
+    """
+    Loads the mat readings saved by resources/get_mat_data.py from folder. Each is a csv file named after the pressure every
+    sensor was seeing, eg matreading_12.3456pa.csv
+    returns: a list of MatReadings, one per file
+    """
+
+    readings = []
+    for path in sorted(Path(folder).glob("*.csv")):
+        reading = MatReading(ROW_WIDTH, COL_HEIGHT, 0, np.loadtxt(path, dtype=np.uint8, delimiter=','))
+        reading.actual_pressure = float(path.name.split('_')[1].split('pa')[0])
+        readings.append(reading)
+
+    return readings
+
+
 class Calibration:
     """
     Class which handles calibrating the mat by taking raw mat readings and converting them into a calibrated mat output of the same size.
@@ -49,8 +244,11 @@ class Calibration:
             self.polyfit_degree = polyfit_degree
             self.listOfMatReadings = []
             self.cal_curves_array = np.empty((self.width, self.height, 3), dtype=np.float64)  # list of coefficients
+            self.cal_lut = np.zeros((self.width * self.height, CAL_LUT_SIZE), dtype=np.double)  # calibrated value of every raw value at every sensor
+            self.cal_lut_offsets = np.arange(self.width * self.height).reshape(self.width, self.height) * CAL_LUT_SIZE  # start of each sensor's row in the flattened lut
             self.calibrated = False
             self.dc_offsets = np.zeros((self.width, self.height), dtype=np.float64)
+            self.dc_offset_pressures = None  # calibrated dc_offsets, cached until the offsets or curves change
             self.zeroing_data = []
 
             # load the default cal curves
@@ -67,9 +265,12 @@ class Calibration:
         self.listOfMatReadings.append(actualMatReading)
 
 
-    def calculate_calibration_curves(self, drop_values_greater_than=255) -> list:
+    def calculate_calibration_curves(self, drop_values_greater_than=255, use_scipy: bool=False, max_workers: int=None, progress_callback=None) -> list:
         """
         updates the cal_curves_array at every sensor with the polyfit results 
+        Sensors are fit all at once with fit_exponential_curves. Any that fail, or all of them if use_scipy is set, are then
+            fit with scipy's general solver on a process pool of max_workers processes (defaults to the number of cpus).
+            progress_callback(sensors_done, total_sensors) is called as the scipy fits complete
         returns the curve fit characteristics
         """
         # clamp the polyfit degree to be one less than the number of calibration samples acquired
@@ -78,50 +279,47 @@ class Calibration:
             self.polyfit_degree = num_weights - 1
             print("Warning: calibrating using lower polyfit degree than specified due to not being fed enough samples")
 
-        num_failures = 0
-        r_squareds = []
-
-        # calculate the calibration curves for each sensor
-        for rows in range(self.width):
-            for cols in range(self.height):
-                matXVals = []
-                matYVals = []
-
-                # iterate over each data sample for this sensor
-                for i in range(num_weights):
-                    x_val = self.listOfMatReadings[i].matMatrix[rows,cols]
-                    y_val = self.listOfMatReadings[i].actual_pressure
-
-                    # eliminate from matXVals and matYVals any values at or over drop_values_greater_than
-                    if x_val < drop_values_greater_than:
-                        matXVals.append(x_val)
-                        matYVals.append(y_val)
-                    else:
-                        print(f"        Skipped datapoint (x={x_val}) at ({rows}, {cols})")
-                
-                x_vals = np.asarray(matXVals)
-                y_vals = np.asarray(matYVals)
-
-                try:
-                    # attempt to fit an exponential curve to this sensor
-                    self.cal_curves_array[rows,cols] = self.fit(x_vals, y_vals, CAL_CURVE_P0)
-                except RuntimeError as e:
-                    # if the calibration fails, use the default calibration values
-                    num_failures += 1
-                    self.cal_curves_array[rows, cols] = CAL_CURVE_P0
-
-                # determine quality of the fit
-                squaredDiffs = np.square(y_vals - self.fit_function(x_vals, *self.cal_curves_array[rows,cols]))
-                squaredDiffsFromMean = np.square(y_vals - np.mean(y_vals))
-                rSquared = 1 - np.sum(squaredDiffs) / np.sum(squaredDiffsFromMean)
-                r_squareds.append(rSquared)
+        # stack the readings so that every sensor is fit at once: x_vals is (sensors, samples), y_vals is (samples,)
+        x_vals = np.stack([reading.matMatrix.reshape(-1) for reading in self.listOfMatReadings], axis=1).astype(np.double)
+        y_vals = np.asarray([reading.actual_pressure for reading in self.listOfMatReadings], dtype=np.double)
+
+        # eliminate any values at or over drop_values_greater_than from the fits
+        valid = x_vals < drop_values_greater_than
+        for sensor, i in np.argwhere(~valid):
+            rows, cols = np.unravel_index(sensor, (self.width, self.height))
+            print(f"        Skipped datapoint (x={x_vals[sensor, i]:.0f}) at ({rows}, {cols})")
+
+        # attempt to fit an exponential curve to every sensor
+        if use_scipy:
+            params = np.empty((x_vals.shape[0], 3), dtype=np.double)
+            converged = np.zeros(x_vals.shape[0], dtype=bool)
+        else:
+            params, converged = fit_exponential_curves(x_vals, y_vals, valid)
+
+        # fall back to scipy's general solver for anything that is left
+        if not np.all(converged):
+            retry = ~converged
+            params[retry], converged[retry] = fit_curves_parallel(x_vals[retry], y_vals, valid[retry], max_workers, progress_callback=progress_callback)
+
+        # if the calibration fails, use the default calibration values
+        num_failures = np.count_nonzero(~converged)
+        params[~converged] = CAL_CURVE_P0
+        self.cal_curves_array = params.reshape(self.width, self.height, 3)
+
+        # determine quality of the fits
+        num_valid = np.count_nonzero(valid, axis=1)
+        y_means = np.sum(np.where(valid, y_vals, 0), axis=1) / num_valid
+        squaredDiffs = np.square(y_vals - self.fit_function(x_vals, *params.T[..., np.newaxis]))
+        squaredDiffsFromMean = np.square(y_vals - y_means[:, np.newaxis])
+        r_squareds = 1 - np.sum(squaredDiffs, axis=1, where=valid) / np.sum(squaredDiffsFromMean, axis=1, where=valid)
+
+        self.build_cal_lut()
 
         print(f"   Calibrated with {num_failures} failures. \n        params min: {np.min(self.cal_curves_array, axis=1)}\n        params max: {np.max(self.cal_curves_array, axis=1)}")
 
         self.calibrated = True
 
         # calculate and return the characteristics of the fits
-        r_squareds = np.asarray(r_squareds)
         min_r2 = np.min(r_squareds)
         avg_r2 = np.average(r_squareds)
 
@@ -134,7 +332,9 @@ class Calibration:
         p0 is the starting point for the function's coefficients
         """
 
-        params, cv = scipy.optimize.curve_fit(self.fit_function, x, y, p0=p0, bounds=CAL_CURVE_BOUNDS, method='trf')
+        import scipy.optimize
+
+        params, cv = scipy.optimize.curve_fit(exponential_curve, x, y, p0=p0, bounds=CAL_CURVE_BOUNDS, method='trf')
         return np.asarray([params]) # return [a, b, c]
 
 
@@ -143,16 +343,15 @@ class Calibration:
         Takes in raw mat readings as a matrix and returns a matrix of the same size with calibrated values
         """
 
-        # initialize return array to be correct width and height and all values equal to zero
+        # raw uint8 readings can be calibrated with a single gather from the precomputed lookup table
+        if matReadings.dtype == np.uint8:
+            return np.take(self.cal_lut, self.cal_lut_offsets + matReadings)
+
+        # anything else (eg averaged zeroing data) has the curves evaluated directly across the whole mat
         # datatype is double because the calibrated value will correspond to a real weight value, and for +- 15% error, needs to be 
         #   at least one decimal of precision at 1lbs
-        calibratedValues = np.zeros((self.width, self.height), dtype=np.double)
-
-        # iterate through every sensor of the mat and calculate the calibrated value at that sensor
-        for rows in range(self.width):
-            for cols in range(self.height):
-                # apply the curve
-                calibratedValues[rows, cols] = self.fit_function(matReadings[rows,cols], * self.cal_curves_array[rows,cols])
+        a, b, c = np.moveaxis(self.cal_curves_array, -1, 0)
+        calibratedValues = self.fit_function(matReadings.astype(np.double), a, b, c)
 
         # clamp the results to sane values
         calibratedValues = np.clip(calibratedValues, 0, MAX_RATED_PRESSURE_PA)
@@ -160,11 +359,59 @@ class Calibration:
         return np.round(calibratedValues, 2)
 
 
+    def build_cal_lut(self):
+        """
+        Precomputes the clamped and rounded calibrated value of every possible raw reading at every sensor.
+        Must be called whenever cal_curves_array changes
+        """
+
+        raw_values = np.arange(CAL_LUT_SIZE, dtype=np.double)
+        curves = self.cal_curves_array.reshape(self.width * self.height, 3)
+
+        lut = self.fit_function(raw_values, curves[:, 0, np.newaxis], curves[:, 1, np.newaxis], curves[:, 2, np.newaxis])
+        lut = np.clip(lut, 0, MAX_RATED_PRESSURE_PA)
+
+        self.cal_lut = np.round(lut, 2)
+
+        # the calibrated offsets depend on the curves, so they must be recalculated
+        self.dc_offset_pressures = None
+
+
+    def snapshot(self) -> dict:
+        """
+        Returns the calibration curves and dc offsets as a json serializable dict, so they can be stored with a session
+        """
+
+        return {
+            "cal_curves": self.cal_curves_array.tolist(),
+            "dc_offsets": self.dc_offsets.tolist(),
+        }
+
+
+    def load_snapshot(self, snapshot: dict):
+        """
+        Loads calibration curves and dc offsets from a dict created by snapshot()
+        """
+
+        self.cal_curves_array = np.asarray(snapshot["cal_curves"], dtype=np.float64)
+        self.dc_offsets = np.asarray(snapshot["dc_offsets"], dtype=np.float64)
+        self.build_cal_lut()
+        self.calibrated = True
+
+
     def load_cal_curves(self, curves_path: str):
         """
         Loads calibration curves from a numpy file
         """
-        self.cal_curves_array = np.load(curves_path, allow_pickle=False)
+        self.set_cal_curves(np.load(curves_path, allow_pickle=False))
+
+
+    def set_cal_curves(self, cal_curves_array: np.ndarray):
+        """
+        Replaces the calibration curves, eg with ones fit by another Calibration
+        """
+        self.cal_curves_array = cal_curves_array
+        self.build_cal_lut()
         self.calibrated = True
 
     
@@ -172,16 +419,21 @@ class Calibration:
         """
         A general exponential function, which calibration curves should be fit to
         """
-        return a * np.exp(b * x) + c
+        return exponential_curve(x, a, b, c)
 
 
     def apply_dc_offsets(self, array_to_offset: np.ndarray):
         """
-        Applys the dc offsets to a passed ndarray/matreading. Run calc_dc_offsets() before use. 
+        Applys the dc offsets in place to a passed ndarray/matreading of calibrated values, and returns it. Run calc_dc_offsets() before use. 
         """
 
+        # the offsets only change when they are recalculated or new curves are loaded, so only calibrate them then
+        if self.dc_offset_pressures is None:
+            self.dc_offset_pressures = self.apply_calibration_curve(self.dc_offsets)
+
         # ensure the offset values never go below zero
-        return np.clip((array_to_offset - self.apply_calibration_curve(self.dc_offsets)), 0, 1000000000)
+        np.subtract(array_to_offset, self.dc_offset_pressures, out=array_to_offset)
+        return np.clip(array_to_offset, 0, 1000000000, out=array_to_offset)
 
 
     def calc_dc_offsets(self):
@@ -193,6 +445,7 @@ class Calibration:
             self.dc_offsets += self.zeroing_data[i].matMatrix
         
         self.dc_offsets = (self.dc_offsets / len(self.zeroing_data))
+        self.dc_offset_pressures = None
 
 
     def add_zeroing_data(self, new_zeroing_data: np.ndarray):
@@ -202,60 +455,3 @@ class Calibration:
 
         print("Added zeroing data")
         self.zeroing_data.append(new_zeroing_data)
-
-
-
-class CalSampleWorker(QObject):
-    """
-    QObject which handles asynchronously acquiring samples of data from the mat for calibration calculations
-    """
-
-    # a signal which is emitted to indicate that the session is complete and the thread should be cleaned up
-    finished = pyqtSignal()
-
-    # a signal to return the sampled MatReading to the caller thread
-    reading_result = pyqtSignal(MatReading)
-
-    def __init__(self, port: int, baud: int, calibration_weight):
-        """
-        Init and run to collect one sample of readings for the weight calibration_weight
-        calibration_weight must be in units lbs
-        """
-
-        super(CalSampleWorker, self).__init__()
-
-        self.port = port
-        self.baud = baud
-        self.calibration_weight = calibration_weight
-
-
-    def run(self):
-        """
-        Main function of the CalSampleWorker
-        """
-
-        with serial.Serial(port=self.port, baudrate=self.baud, timeout=10) as ser:
-            # request calibration readings from the mat
-            ser.write((START_READING_COMMAND + '\n').encode('utf-8'))
-
-            # read the mat's response
-            bytes = ser.read(VERIFICATION_WIDTH + MAT_SIZE)
-            if bytes == b'':
-                print("Serial timed out!")
-                return
-                
-            flat_mat = [x for x in bytes]
-
-            # ensure that the verifiation message was aligned
-            for ver, val in zip(VERIFICATION_SEQUENCE, flat_mat[-4:]):
-                if not (ver == val):
-                    raise Exception("Verification sequence not found in mat transmission")
-
-            # construct a reading from the response
-            mat_vals = mat_list_to_array(flat_mat)
-            reading = MatReading(ROW_WIDTH, COL_HEIGHT, self.calibration_weight, mat_vals)
-
-            # send the reading to the main thread
-            self.reading_result.emit(reading)
-
-        self.finished.emit()
\ No newline at end of file
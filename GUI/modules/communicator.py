@@ -1,22 +1,16 @@
 """
-Module responsible for communicating directly with the PMI
+Module containing the Qt workers which communicate with the PMI off of the GUI thread.
+They are thin adapters which turn the callbacks of the headless acquisition engine (see acquisition.py) into Qt signals
 """
 
 from PyQt6.QtCore import QObject, pyqtSignal
 
-from datetime import datetime
-import os, time
-
-from pathlib import Path
-
-import serial
-import serial.tools.list_ports
-
 import numpy as np
-from PIL import Image
 
-from modules.calibration import Calibration
+from modules.acquisition import *
+from modules.calibration import Calibration, MatReading
 from modules.mat_handler import *
+from modules.session_file import WRITE_QUEUE_SIZE, WRITE_POLICY_BLOCK
 
 
 class SessionWorker(QObject):
@@ -28,127 +22,30 @@ class SessionWorker(QObject):
     # a signal which is emitted to indicate that the session is complete and the thread should be cleaned up
     finished = pyqtSignal()
 
-    # a signal which indicates pressure data has been saved at the path in the signal
-    calculated_pressures = pyqtSignal(np.ndarray)
-
-    # a signal used to transmit live formatted statistics about the session
-    session_stats = pyqtSignal(str)
-
     # a signal used to transmit statistics about the session after it has finished
     finished_session_stats = pyqtSignal(str)
 
-    def __init__(self, port: int, baud: int, calibrator: Calibration=None):
+    def __init__(self, port: int, baud: int, calibrator: Calibration=None, write_queue_size: int=WRITE_QUEUE_SIZE,
+                 write_policy: str=WRITE_POLICY_BLOCK, record_raw: bool=False, mode: str=ACQUISITION_MODE_LOSSLESS):
         super(SessionWorker, self).__init__()
 
-        self.path = self.setup()
-        self.port = port
-        self.baud = int(baud)
-        self.polling = False
-        self.calibrator = calibrator
-
-        # variables used to track statistics about the session
-        self.start_time_ns = time.time_ns()
-        self.delta_times = []
-        self.transmission_errors = 0
+        self.engine = AcquisitionEngine(port, baud, calibrator, write_queue_size=write_queue_size,
+                                        write_policy=write_policy, record_raw=record_raw, mode=mode)
+        self.path = self.engine.path
 
-
-    def setup(self):
-        """
-        gets current date and time in the format of yy_mm_dd_THH_MM_SS
-        finds the current working directory then adds a folder named after the current time to /sessions
-        """
-
-        now = datetime.now()
-        folderName = now.strftime("%y_%m_%d_T%H_%M_%S")
-
-        i = 0
-        while(True):
-            # attempt to create the folder, and increment its number by one if the creation fails
-            try:
-                path = os.getcwd() + "\sessions\\" + folderName + f"_{i}"
-                os.mkdir(path)
-                break
-            except FileExistsError as e:
-                i += 1
-                continue
-
-        return path
+        # the GUI takes the newest pressure array and live statistics out of these at its own refresh rate
+        self.pressures_mailbox = self.engine.pressures_mailbox
+        self.stats_mailbox = self.engine.stats_mailbox
 
 
     def run(self):
         """
         Main loop of the session worker
         """
-        
-        print('run.')
 
-        # exit if the port does not exist
-        ports = [tuple(p)[0] for p in list(serial.tools.list_ports.comports())]
-        if self.port not in ports:
-            print("Port does not exist")
+        print('run.')
+        if not self.engine.run():
             self.stop()
-            return
-        
-        print("opening serial")
-        # connect to the PMI
-        with serial.Serial(self.port, baudrate=self.baud, timeout=10) as ser:
-            ser.set_buffer_size(rx_size = 1700, tx_size = 1700)
-            
-            # send the message to start reading the mat
-            ser.write((START_READING_COMMAND + '\n').encode('utf-8'))
-            self.polling = True
-
-            prev_sample_time_ns = time.time_ns()
-
-            # continually poll serial for new mat data
-            while self.polling:
-                # mat data is transmitted as raw bytes
-                bytes = ser.read(VERIFICATION_WIDTH + MAT_SIZE)
-                if bytes == b'':
-                    print("Serial timed out!")
-                    continue
-                
-                flat_mat = [x for x in bytes]
-
-                # ensure that the verifiation message was aligned
-                for ver, val in zip(VERIFICATION_SEQUENCE, flat_mat[-4:]):
-                    if not (ver == val):
-                        self.transmission_errors += 1
-                        print("====TRANSMISSION ERROR OCCURED! FIXING!!!====")
-                        # a verification error has occured, probably because the fifo filled up
-                        # to resolve it, simply wipe the fifo and read until the next verification sequence
-                        ser.reset_input_buffer()
-                        hist = np.zeros(VERIFICATION_WIDTH, dtype=np.uint8)
-
-                        # wait for verification sequence to be found, proving data stream is still intact
-                        while(not np.array_equal(hist, np.asarray(VERIFICATION_SEQUENCE, dtype=np.uint8))):
-                            hist = np.roll(hist, -1)
-                            hist[-1] = int.from_bytes(ser.read(1), "big")
-
-                        break   # do not false positive another error
-
-                # process the collected data
-                data_array = mat_list_to_array(flat_mat)
-
-                pressure_array = self.calibrator.apply_calibration_curve(data_array)
-                pressure_array = self.calibrator.apply_dc_offsets(pressure_array)
-
-                # save the pressure values as an npy
-                self.save_npy(pressure_array)
-                self.calculated_pressures.emit(pressure_array)
-
-                # update the timing statistics
-                now_ns = time.time_ns()
-                delta_ns = now_ns - prev_sample_time_ns
-                self.delta_times.append(delta_ns)
-                prev_sample_time_ns = now_ns
-
-                # prevent division by zero
-                delta_ns = max(1, delta_ns)
-
-                msg = f"Sample rate: {(1/delta_ns * 1000000000):.2f}Hz\nQueued RX size: {ser.in_waiting}\n"
-                msg += f"Total session time: {((time.time_ns() - self.start_time_ns) / 1000000000):.2f}s\n"
-                self.session_stats.emit(msg)
 
 
     def stop(self):
@@ -156,37 +53,88 @@ class SessionWorker(QObject):
         Stops the session worker
         """
 
-        print('stopping')
-        self.polling = False
-
-        # calculate the finished session stats and emit to the parent thread
-        average_delta_ns = np.average(self.delta_times)
-        average_sample_rate = 1 / average_delta_ns * 1000000000
-
-        msg = f"Average sample rate: {average_sample_rate:02f}Hz\n"
-        msg += f"Total # transmission errors: {self.transmission_errors}\n"
+        self.engine.stop()
 
-        self.finished_session_stats.emit(msg)
+        # emit the finished session stats to the parent thread
+        self.finished_session_stats.emit(self.engine.summary())
 
         # clean up this thread
         self.finished.emit()
 
 
-    def save_npy(self, pressure_array: np.ndarray):
+    def __str__(self):
+        return str(self.engine)
+
+
+class CalSampleWorker(QObject):
+    """
+    QObject which handles asynchronously acquiring samples of data from the mat for calibration calculations
+    """
+
+    # a signal which is emitted to indicate that the session is complete and the thread should be cleaned up
+    finished = pyqtSignal()
+
+    # a signal to return the sampled MatReading to the caller thread
+    reading_result = pyqtSignal(MatReading)
+
+    def __init__(self, port: int, baud: int, calibration_weight):
         """
-        Saves a numpy array of pressure values to disk
-        returns: filepath of the saved npy file
+        Init and run to collect one sample of readings for the weight calibration_weight
+        calibration_weight must be in units lbs
         """
-        
-        # create the npy's filename
-        sample_num = len(list(Path(self.path).glob('*')))
-        sample_path = Path(self.path).joinpath(f"{sample_num:05d}.npy")
 
-        np.save(sample_path, pressure_array, allow_pickle=False)
+        super(CalSampleWorker, self).__init__()
 
-        return sample_path
+        self.port = port
+        self.baud = baud
+        self.calibration_weight = calibration_weight
 
 
-    def __str__(self):
-        return f"Session at {self.port=}, {self.baud=}"
+    def run(self):
+        """
+        Main function of the CalSampleWorker
+        """
+
+        reading = sample_mat_reading(self.port, self.baud, self.calibration_weight)
+        if reading is None:
+            return
+
+        # send the reading to the main thread
+        self.reading_result.emit(reading)
+
+        self.finished.emit()
+
+
+class CalibrationWorker(QObject):
+    """
+    QObject which handles calculating calibration curves off of the GUI thread and reporting the progress of the fits
+    """
 
+    # a signal which is emitted to indicate that the calibration is complete and the thread should be cleaned up
+    finished = pyqtSignal()
+
+    # a signal reporting (sensors_done, total_sensors) while sensors are being fit with scipy
+    progress = pyqtSignal(int, int)
+
+    # a signal to return the minimum and average R^2 of the fits to the caller thread
+    fit_result = pyqtSignal(float, float)
+
+    def __init__(self, calibration: Calibration, drop_values_greater_than=255, use_scipy: bool=False, max_workers: int=None):
+        super(CalibrationWorker, self).__init__()
+
+        self.calibration = calibration
+        self.drop_values_greater_than = drop_values_greater_than
+        self.use_scipy = use_scipy
+        self.max_workers = max_workers
+
+
+    def run(self):
+        """
+        Main function of the CalibrationWorker
+        """
+
+        min_r2, avg_r2 = self.calibration.calculate_calibration_curves(self.drop_values_greater_than, self.use_scipy,
+                                                                       self.max_workers, progress_callback=self.progress.emit)
+        self.fit_result.emit(float(min_r2), float(avg_r2))
+
+        self.finished.emit()
@@ -0,0 +1,348 @@
+"""
+Module which emulates the PMI on a pseudo-terminal, so the GUI, the acquisition engine and the resource scripts can be run
+without the board. The emulator speaks the protocol of board_code/src/shared/transmitter.c: it reads newline terminated
+commands, sends one frame for GET_CAL_VALS_COMMAND, and after START_READING_COMMAND streams frames until it is reset
+(the real board streams until it is powered off). Streamed frames are sent in whichever of frame_formats was last agreed
+with FRAME_FORMAT_COMMAND, so both legacy and checked boards can be emulated.
+Faults such as misaligned, dropped or corrupted bytes can be injected on demand.
+Pseudo-terminals only exist on POSIX systems, so VirtualPMI can not be used on Windows, but the frame generators can
+"""
+
+import os, select, threading, time
+
+import numpy as np
+
+from modules.mat_handler import *
+from modules.session_archive import open_session
+
+EMULATOR_FRAME_RATE_HZ = 100        # default number of frames streamed per second
+EMULATOR_MAX_READING = 207          # largest reading the real mat reports, so frames can not contain the verification sequence
+EMULATOR_INFO_MESSAGE = b"This is PressureMat software for the virtual PMI!\n"
+EMULATOR_UNRECOGNIZED_MESSAGE = b"Unrecognized command\n"
+EMULATOR_POLL_INTERVAL_S = 0.05     # longest the emulator thread waits before checking if it should stop
+
+
+def synthetic_frames(seed=None, noise: float=2, num_blobs: int=2, blob_reading: float=150, blob_radius: float=4,
+                     speed: float=0.5):
+    """
+    Generator which yields an endless stream of synthetic (ROW_WIDTH, COL_HEIGHT) uint8 readings: num_blobs gaussian
+    blobs of pressure (eg feet) which wander around the mat and bounce off its edges, on top of a noisy baseline
+    """
+
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.arange(ROW_WIDTH), np.arange(COL_HEIGHT), indexing='ij')
+    size = np.array([ROW_WIDTH, COL_HEIGHT], dtype=np.double)
+
+    positions = rng.uniform(0, 1, (num_blobs, 2)) * size
+    velocities = rng.normal(0, speed, (num_blobs, 2))
+
+    while True:
+        readings = np.abs(rng.normal(0, noise, (ROW_WIDTH, COL_HEIGHT)))
+        for px, py in positions:
+            readings += blob_reading * np.exp(-((x - px) ** 2 + (y - py) ** 2) / (2 * blob_radius ** 2))
+
+        yield np.clip(np.round(readings), 0, EMULATOR_MAX_READING).astype(np.uint8)
+
+        # move the blobs, bouncing them off the edges of the mat
+        positions += velocities
+        outside = (positions < 0) | (positions >= size)
+        velocities[outside] *= -1
+        positions = np.clip(positions, 0, size - 1)
+
+
+def pressures_to_readings(pressure_array: np.ndarray, calibration) -> np.ndarray:
+    """
+    Converts calibrated pressures back to the raw readings which would produce them, using the Calibration's lookup table.
+    The dc offsets that were subtracted from the pressures are not added back
+    """
+
+    # the calibrated pressure of each sensor never decreases as its reading increases, so the reading is the number of
+    # entries in the sensor's lookup table that are below the pressure
+    readings = np.sum(calibration.cal_lut < pressure_array.reshape(-1, 1), axis=1)
+    return np.minimum(readings, EMULATOR_MAX_READING).astype(np.uint8).reshape(pressure_array.shape)
+
+
+def session_frames(path, calibration=None, loop: bool=True):
+    """
+    Returns a generator which yields the readings of a recorded session (any format open_session() accepts), from the
+    start again once it runs out if loop is set. Sessions of calibrated pressures are converted back to readings with calibration
+    """
+
+    reader = open_session(path)
+    if not reader.raw and calibration is None:
+        reader.close()
+        raise ValueError(f"{path} holds pressures, so a calibration is needed to convert them back to readings")
+
+    def generate():
+        try:
+            while True:
+                for i in range(len(reader)):
+                    frame = reader.read_frames(i)
+                    yield np.asarray(frame, dtype=np.uint8) if reader.raw else pressures_to_readings(frame, calibration)
+
+                if not loop or len(reader) == 0:
+                    return
+        finally:
+            reader.close()
+
+    return generate()
+
+
+class VirtualPMI:
+    """
+    Class which emulates the PMI on a pseudo-terminal from a thread. Open self.port like the serial port of the real board.
+    frames is an iterator of (ROW_WIDTH, COL_HEIGHT) uint8 readings (see synthetic_frames() and session_frames()).
+    Every misalign_every frames, misalign_bytes of junk are sent before a frame, every drop_every frames,
+    drop_bytes are cut out of a frame, as happens when the board's fifo overflows, and every corrupt_every frames one
+    byte of the mat values is changed. 0 disables any of the faults.
+    frame_formats are the formats the emulated board supports (see FRAME_FORMAT_COMMAND); legacy boards only support
+    FRAME_FORMAT_LEGACY, and answer FRAME_FORMAT_COMMAND as an unrecognized command
+    """
+
+    def __init__(self, frames, frame_rate_hz: float=EMULATOR_FRAME_RATE_HZ, misalign_every: int=0, misalign_bytes: int=3,
+                 drop_every: int=0, drop_bytes: int=3, seed=None, corrupt_every: int=0,
+                 frame_formats: tuple=(FRAME_FORMAT_LEGACY, FRAME_FORMAT_CHECKED)):
+        self.frames = iter(frames)
+        self.frame_period_s = 1 / frame_rate_hz if frame_rate_hz else 0     # 0 streams as fast as the host reads
+        self.misalign_every = misalign_every
+        self.misalign_bytes = misalign_bytes
+        self.drop_every = drop_every
+        self.drop_bytes = drop_bytes
+        self.corrupt_every = corrupt_every
+        self.frame_formats = frame_formats
+        self.rng = np.random.default_rng(seed)
+
+        import pty, tty
+
+        # the board side of the pty is the master, and the host opens the slave. The slave is held open so the pty
+        # lives on while hosts connect and disconnect
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+
+        self.streaming = False
+        self.frame_format = FRAME_FORMAT_LEGACY     # format of streamed frames, until another one is agreed
+        self.command = bytearray()      # the command being received
+        self.outgoing = bytearray()     # bytes waiting for the host to read them
+        self.lock = threading.Lock()    # guards the faults requested by other threads
+        self.pending_misalignment = 0
+        self.pending_drop = 0
+        self.pending_corruption = 0
+
+        # statistics about the emulator
+        self.frames_sent = 0
+        self.commands_received = 0
+        self.bytes_injected = 0
+        self.bytes_dropped = 0
+        self.frames_corrupted = 0
+
+        self.running = False
+        self.thread = None
+
+
+    def start(self):
+        """
+        Starts emulating the board
+        returns: the port to connect to
+        """
+
+        self.running = True
+        self.thread = threading.Thread(target=self.serve_loop, name="VirtualPMIThread", daemon=True)
+        self.thread.start()
+        return self.port
+
+
+    def inject_misalignment(self, num_bytes: int=None):
+        """
+        Sends num_bytes (default misalign_bytes) of junk before the next frame
+        """
+
+        with self.lock:
+            self.pending_misalignment += num_bytes if num_bytes is not None else self.misalign_bytes
+
+
+    def drop(self, num_bytes: int=None):
+        """
+        Cuts num_bytes (default drop_bytes) out of the middle of the next frame
+        """
+
+        with self.lock:
+            self.pending_drop += num_bytes if num_bytes is not None else self.drop_bytes
+
+
+    def corrupt(self, num_frames: int=1):
+        """
+        Changes one byte of the mat values of each of the next num_frames frames
+        """
+
+        with self.lock:
+            self.pending_corruption += num_frames
+
+
+    def reset(self):
+        """
+        Stops streaming and waits for commands again, like power cycling the board
+        """
+
+        self.streaming = False
+        self.frame_format = FRAME_FORMAT_LEGACY
+
+
+    def serve_loop(self):
+        """
+        Main loop of the emulator thread. Receives commands, and sends whatever is queued as fast as the host reads it
+        """
+
+        next_frame_time = time.monotonic()
+
+        while self.running:
+            timeout = EMULATOR_POLL_INTERVAL_S
+            if self.streaming and not self.outgoing:
+                timeout = min(timeout, max(0, next_frame_time - time.monotonic()))
+
+            # only wait for the pty to be writable when there is something to send, so a host that is not reading
+            # holds the board up like a full usb buffer would
+            readable, writable, _ = select.select([self.master], [self.master] if self.outgoing else [], [], timeout)
+
+            if readable:
+                self.receive()
+
+            if writable:
+                try:
+                    sent = os.write(self.master, self.outgoing)
+                    del self.outgoing[:sent]
+                except BlockingIOError:
+                    pass
+
+            if self.streaming and not self.outgoing and time.monotonic() >= next_frame_time:
+                self.queue_frame()
+                # keep to the frame rate, but do not burst to catch up after the host stalled
+                next_frame_time = max(next_frame_time + self.frame_period_s, time.monotonic() - self.frame_period_s)
+
+
+    def receive(self):
+        """
+        Reads bytes sent by the host and handles every complete command
+        """
+
+        try:
+            data = os.read(self.master, 1024)
+        except (BlockingIOError, OSError):
+            return
+
+        for byte in data:
+            if byte not in b"\r\n":
+                self.command.append(byte)
+                continue
+
+            command, self.command = self.command.decode('utf-8', errors='replace'), bytearray()
+            if command:
+                self.handle_command(command)
+
+
+    def handle_command(self, command: str):
+        """
+        Responds to one command from the host, as the main loop of the board's firmware does
+        """
+
+        self.commands_received += 1
+
+        # once the board is streaming, it no longer listens for commands
+        if self.streaming:
+            return
+
+        if command == START_READING_COMMAND:
+            self.streaming = True
+        elif command == GET_CAL_VALS_COMMAND:
+            self.queue_frame(FRAME_FORMAT_LEGACY)
+        elif command.startswith(FRAME_FORMAT_COMMAND + " ") and command.split(" ", 1)[1] in [str(f) for f in self.frame_formats]:
+            self.frame_format = int(command.split(" ", 1)[1])
+            self.outgoing += (command + "\n").encode('utf-8')
+        elif command == PRINT_INFO_COMMAND:
+            self.outgoing += EMULATOR_INFO_MESSAGE
+        else:
+            self.outgoing += EMULATOR_UNRECOGNIZED_MESSAGE
+
+
+    def queue_frame(self, frame_format: int=None):
+        """
+        Encodes the next frame in frame_format (default the agreed streaming format), applies any faults to it,
+        and queues it to be sent
+        """
+
+        frame_format = frame_format if frame_format is not None else self.frame_format
+        try:
+            counter = self.frames_sent if frame_format == FRAME_FORMAT_CHECKED else None
+            frame = bytearray(encode_mat_frame(next(self.frames), counter))
+        except StopIteration:
+            # the session has been played back in full
+            self.streaming = False
+            return
+
+        self.frames_sent += 1
+
+        with self.lock:
+            if self.misalign_every and self.frames_sent % self.misalign_every == 0:
+                self.pending_misalignment += self.misalign_bytes
+            if self.drop_every and self.frames_sent % self.drop_every == 0:
+                self.pending_drop += self.drop_bytes
+            if self.corrupt_every and self.frames_sent % self.corrupt_every == 0:
+                self.pending_corruption += 1
+
+            misalignment, self.pending_misalignment = self.pending_misalignment, 0
+            drop, self.pending_drop = min(self.pending_drop, len(frame)), 0
+            corrupt = self.pending_corruption > 0
+            self.pending_corruption = max(self.pending_corruption - 1, 0)
+
+        if corrupt:
+            # flip the lowest bit of one reading, which keeps it below the verification sequence's values
+            frame[int(self.rng.integers(0, MAT_SIZE))] ^= 0x01
+            self.frames_corrupted += 1
+
+        if drop:
+            start = int(self.rng.integers(0, len(frame) - drop + 1))
+            del frame[start:start + drop]
+            self.bytes_dropped += drop
+
+        if misalignment:
+            self.outgoing += self.rng.integers(0, EMULATOR_MAX_READING + 1, misalignment, dtype=np.uint8).tobytes()
+            self.bytes_injected += misalignment
+
+        self.outgoing += frame
+
+
+    def stats(self) -> dict:
+        """
+        Returns statistics about the emulator
+        """
+
+        return {
+            "frames_sent": self.frames_sent,
+            "commands_received": self.commands_received,
+            "bytes_injected": self.bytes_injected,
+            "bytes_dropped": self.bytes_dropped,
+            "frames_corrupted": self.frames_corrupted,
+        }
+
+
+    def close(self):
+        """
+        Stops the emulator thread and closes the pty
+        """
+
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+        os.close(self.master)
+        os.close(self.slave)
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,128 @@
+"""
+Module responsible for splitting the raw byte stream sent by the PMI into aligned mat frames
+"""
+
+from modules.mat_handler import *
+
+
+class FrameParser:
+    """
+    Class which buffers bytes read from the PMI and yields complete frames (mat values followed by the verification sequence).
+    When the stream is misaligned, eg because the serial fifo overflowed, it resynchronizes on the next verification sequence
+    and counts the bytes it had to throw away.
+    Checked frames (see FRAME_FORMAT_CHECKED) are only yielded if their CRC matches, and gaps in their frame counter are
+    counted as lost frames. Legacy frames carry neither, so frames_lost and corrupt_frames stay 0 for them
+    """
+
+    def __init__(self, frame_format: int=FRAME_FORMAT_LEGACY):
+        self.frame_format = frame_format
+        self.frame_size = FRAME_SIZES[frame_format]
+        self.trailer_offset = self.frame_size - VERIFICATION_WIDTH  # where the verification sequence starts in a frame
+
+        self.buffer = bytearray()
+        self.start = 0              # index of the first unparsed byte in the buffer
+        self.aligned = True         # False while bytes are being discarded to find the start of a frame
+        self.last_counter = None    # frame counter of the last checked frame
+
+        # statistics about the stream
+        self.frames_parsed = 0
+        self.discarded_bytes = 0
+        self.resyncs = 0
+        self.frames_lost = 0        # frames missing from the counter sequence, including any that were corrupted
+        self.corrupt_frames = 0     # aligned frames whose CRC did not match
+
+
+    def buffered(self) -> int:
+        """
+        Returns the number of bytes waiting to be parsed
+        """
+        return len(self.buffer) - self.start
+
+
+    def read_size(self, in_waiting: int=0) -> int:
+        """
+        Returns how many bytes should be requested from serial: everything that is already waiting,
+        or at least enough to complete the next frame
+        """
+        return max(in_waiting, self.frame_size - self.buffered(), 1)
+
+
+    def feed(self, data: bytes):
+        """
+        Adds bytes read from the PMI to the end of the buffer
+        """
+
+        # drop the already parsed bytes once they make up most of the buffer, so it does not grow forever
+        if self.start > len(self.buffer) // 2:
+            del self.buffer[:self.start]
+            self.start = 0
+
+        self.buffer += data
+
+
+    def frames(self):
+        """
+        Generator which yields every complete, aligned (and for checked frames, intact) frame in the buffer
+        as a bytearray of length frame_size
+        """
+
+        while self.buffered() >= self.frame_size:
+            trailer = self.start + self.trailer_offset
+
+            if self.buffer[trailer:trailer + VERIFICATION_WIDTH] != VERIFICATION_BYTES:
+                # misaligned, so skip ahead to the next frame that is followed by a verification sequence
+                self.resync()
+                continue
+
+            frame = self.buffer[self.start:self.start + self.frame_size]
+            self.start += self.frame_size
+            self.aligned = True
+
+            if self.frame_format == FRAME_FORMAT_CHECKED and not self.check(frame):
+                continue
+
+            self.frames_parsed += 1
+            yield frame
+
+
+    def check(self, frame: bytearray) -> bool:
+        """
+        Verifies the CRC of a checked frame, and counts any frames missing between it and the last one
+        returns: True if the frame is intact
+        """
+
+        if not frame_crc_valid(frame):
+            self.corrupt_frames += 1
+            self.discarded_bytes += self.frame_size
+            return False
+
+        counter = frame_counter(frame)
+        if self.last_counter is not None:
+            self.frames_lost += (counter - self.last_counter - 1) % FRAME_COUNTER_MODULO
+        self.last_counter = counter
+
+        return True
+
+
+    def resync(self):
+        """
+        Discards bytes from the front of the buffer until it is aligned with the start of a frame again
+        """
+
+        # only count the first attempt of each resync, as more bytes may need to arrive before it succeeds
+        if self.aligned:
+            self.resyncs += 1
+            self.aligned = False
+
+        # the verification sequence can not be at the end of the current frame, so search after that point
+        found = self.buffer.find(VERIFICATION_BYTES, self.start + self.trailer_offset + 1)
+
+        if found == -1:
+            # keep enough bytes to hold a frame whose verification sequence has not fully arrived yet
+            new_start = len(self.buffer) - (self.frame_size - 1)
+        else:
+            # the bytes before the verification sequence are a complete frame
+            new_start = found - self.trailer_offset
+
+        self.discarded_bytes += new_start - self.start
+        self.start = new_start
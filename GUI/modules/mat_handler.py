@@ -2,7 +2,7 @@
 File for helper functions related to the Mat that multiple modules may need to import
 """
 import numpy as np
-import os
+import binascii, os
 
 # pressure mat physical characteristics
 ROW_WIDTH = 28
@@ -14,10 +14,26 @@ MAT_AREA_SQM = 0.1568       # Area of the entire mat in square meters
 # serial commands
 START_READING_COMMAND = "start_reading"
 GET_CAL_VALS_COMMAND = "get_cal_vals"
+PRINT_INFO_COMMAND = "print_info"
+FRAME_FORMAT_COMMAND = "frame_format"   # sent as "frame_format <format>" before START_READING_COMMAND, and echoed back if supported
 
 # the verificaiton message sent by the board
 VERIFICATION_WIDTH = 4
 VERIFICATION_SEQUENCE = [255, 254, 254, 255]
+VERIFICATION_BYTES = bytes(VERIFICATION_SEQUENCE)
+FRAME_SIZE = MAT_SIZE + VERIFICATION_WIDTH  # size of one mat transmission including the verification sequence
+
+# formats of the frames streamed by the board. Legacy frames are the mat values followed by the verification sequence.
+# Checked frames put a frame counter and a CRC-16/CCITT-FALSE of the mat values and counter (both uint16, little endian)
+# between the two, so that dropped and corrupted frames can be detected
+FRAME_FORMAT_LEGACY = 1
+FRAME_FORMAT_CHECKED = 2
+FRAME_COUNTER_WIDTH = 2
+FRAME_COUNTER_MODULO = 2 ** (8 * FRAME_COUNTER_WIDTH)
+FRAME_CRC_WIDTH = 2
+FRAME_CRC_INIT = 0xFFFF
+CHECKED_FRAME_SIZE = MAT_SIZE + FRAME_COUNTER_WIDTH + FRAME_CRC_WIDTH + VERIFICATION_WIDTH
+FRAME_SIZES = {FRAME_FORMAT_LEGACY: FRAME_SIZE, FRAME_FORMAT_CHECKED: CHECKED_FRAME_SIZE}
 
 
 def print_2darray(array: np.ndarray, highlight_max: bool=False):
@@ -72,18 +88,64 @@ def mat_list_to_array(mat_as_list: list):
     Converts a 1d python list (presumably the mat) to a 2D numpy array
     """
 
-    array = np.empty((ROW_WIDTH, COL_HEIGHT), dtype=np.uint8)
-    x = 0
-    y = 0
-    for i in range(MAT_SIZE):
-        if (i % ROW_WIDTH) == 0 and i > 0:
-            y += 1
-            x = 0
+    return np.asarray(mat_as_list[:MAT_SIZE], dtype=np.uint8).reshape(COL_HEIGHT, ROW_WIDTH).T.copy()
+
+
+def frame_is_aligned(frame: bytes) -> bool:
+    """
+    Checks that a raw mat transmission (as read from serial) ends with the verification sequence
+    """
+
+    return len(frame) == FRAME_SIZE and frame[MAT_SIZE:] == VERIFICATION_BYTES
+
+
+def decode_mat_frame(frame: bytes) -> np.ndarray:
+    """
+    Converts a raw mat transmission (bytes, bytearray or memoryview as read from serial) to a 2D numpy array
+    without copying. The mat is sent one row of ROW_WIDTH values at a time, so the result is a read only
+    transposed view of the frame's buffer
+    """
+
+    return np.frombuffer(frame, dtype=np.uint8, count=MAT_SIZE).reshape(COL_HEIGHT, ROW_WIDTH).T
+
+
+def encode_mat_frame(mat: np.ndarray, counter: int=None) -> bytes:
+    """
+    Converts a 2D (ROW_WIDTH, COL_HEIGHT) array of readings to a mat transmission as the PMI sends it, the inverse of decode_mat_frame.
+    If counter is given, a checked frame with that frame counter is made instead of a legacy frame
+    """
 
-        array[x, y] = mat_as_list[i]
-        x += 1
+    values = np.ascontiguousarray(mat.T, dtype=np.uint8).tobytes()
+    if counter is None:
+        return values + VERIFICATION_BYTES
+
+    checked = values + (counter % FRAME_COUNTER_MODULO).to_bytes(FRAME_COUNTER_WIDTH, "little")
+    return checked + frame_crc(checked).to_bytes(FRAME_CRC_WIDTH, "little") + VERIFICATION_BYTES
+
+
+def frame_crc(data: bytes) -> int:
+    """
+    Calculates the CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF) of bytes, as used by checked frames
+    """
+
+    return binascii.crc_hqx(data, FRAME_CRC_INIT)
+
+
+def frame_counter(frame: bytes) -> int:
+    """
+    Returns the frame counter of a checked frame
+    """
+
+    return int.from_bytes(frame[MAT_SIZE:MAT_SIZE + FRAME_COUNTER_WIDTH], "little")
+
+
+def frame_crc_valid(frame: bytes) -> bool:
+    """
+    Checks that the CRC of a checked frame matches its mat values and frame counter
+    """
 
-    return array
+    crc_start = MAT_SIZE + FRAME_COUNTER_WIDTH
+    return frame_crc(frame[:crc_start]) == int.from_bytes(frame[crc_start:crc_start + FRAME_CRC_WIDTH], "little")
 
 
 def lbs_to_newtons(force_lbs: float) -> float:
@@ -112,29 +174,105 @@ def calc_percent_error(experimental, theoretical):
     return np.abs((experimental - theoretical) / theoretical) * 100
 
 
+def calc_mat_reading_stats_data(mat_samples_pa: np.array, expected_weight: float) -> dict:
+    """
+    Calculates some useful statistics about the mat reading and returns them as a dict.
+    The percent error statistics are only included if expected_weight is greater than zero
+    """
+
+    stats = {
+        "max_pa": np.max(mat_samples_pa),
+        "min_pa": np.min(mat_samples_pa),
+        "average_pa": round(np.average(mat_samples_pa), 2),
+    }
+
+    if expected_weight > 0:
+        expected_pa = distributed_lbs_to_sensor_pressure(expected_weight)
+
+        # percent error of every sensor at once
+        errors = np.abs(calc_percent_error(mat_samples_pa.ravel(), expected_pa))
+
+        stats["expected_pa"] = expected_pa
+        stats["min_err"] = round(np.min(errors), 2)
+        stats["max_err"] = round(np.max(errors), 2)
+        stats["avg_err"] = round(np.average(errors), 2)
+        stats["median_err"] = round(np.median(errors), 2)
+
+    return stats
+
+
 def calc_mat_reading_stats(mat_samples_pa: np.array, expected_weight: float):
     """
     Calculates some useful statistics about the mat reading and returns them as a string
     """
 
-    flat_mat = mat_samples_pa.flatten()
-    max_pa = np.max(flat_mat)
-    min_pa = np.min(flat_mat)
-    average_pa = round(np.average(flat_mat), 2)
+    stats = calc_mat_reading_stats_data(mat_samples_pa, expected_weight)
 
     errors_msg = "Put the expected distributed weight value (in lbs) into the entry to the left to see error!"
-    if expected_weight > 0:
-        expected_pa = distributed_lbs_to_sensor_pressure(expected_weight)
+    if "expected_pa" in stats:
+        errors_msg = f"Expected Pressure on each sensor: {stats['expected_pa']:.3f}\n    Errors:\n    Min % err: {stats['min_err']}\n    Max % err: {stats['max_err']}\n    Avg % err: {stats['avg_err']}\n    Median % err: {stats['median_err']}"
+
+    return f"    Max pressure: {stats['max_pa']:.3f}Pa\n    Min pressure: {stats['min_pa']:.3f}Pa\n    Avg pressure: {stats['average_pa']:.3f}Pa\n    {errors_msg}"
+
+
+class SensorRunningStats:
+    """
+    Class which keeps the running mean, variance, minimum and maximum of every sensor over a session,
+    using Welford's algorithm so that each new frame is an O(1) update per sensor
+    """
+
+    def __init__(self, shape: tuple=(ROW_WIDTH, COL_HEIGHT)):
+        self.shape = tuple(shape)
+        self.count = 0
+        self.mean = np.zeros(self.shape, dtype=np.double)
+        self.m2 = np.zeros(self.shape, dtype=np.double)     # sum of squared differences from the mean
+        self.min = np.full(self.shape, np.inf)
+        self.max = np.full(self.shape, -np.inf)
+        self.delta = np.empty(self.shape, dtype=np.double)  # scratch buffer for update()
+
+
+    def update(self, frame: np.ndarray):
+        """
+        Adds one frame to the running statistics
+        """
+
+        self.count += 1
+
+        # delta = x - old mean, mean += delta / n, m2 += delta * (x - new mean)
+        np.subtract(frame, self.mean, out=self.delta)
+        self.mean += self.delta / self.count
+        self.m2 += self.delta * (frame - self.mean)
+
+        np.minimum(self.min, frame, out=self.min)
+        np.maximum(self.max, frame, out=self.max)
+
+
+    def variance(self) -> np.ndarray:
+        """
+        Returns the sample variance of every sensor
+        """
+
+        if self.count < 2:
+            return np.zeros(self.shape, dtype=np.double)
+        return self.m2 / (self.count - 1)
+
 
-        errors = np.empty_like(flat_mat)
-        for i in range(len(errors)):
-            errors[i] = calc_percent_error(flat_mat[i], expected_pa)
+    def std(self) -> np.ndarray:
+        """
+        Returns the sample standard deviation (noise) of every sensor
+        """
+        return np.sqrt(self.variance())
 
-        min_err = round(np.min(np.abs(errors)), 2)
-        max_err = round(np.max(np.abs(errors)), 2)
-        avg_err = round(np.average(np.abs(errors)), 2)
-        median_err = round(np.median(np.abs(errors)), 2)
 
-        errors_msg = f"Expected Pressure on each sensor: {expected_pa:.3f}\n    Errors:\n    Min % err: {min_err}\n    Max % err: {max_err}\n    Avg % err: {avg_err}\n    Median % err: {median_err}"
+    def data(self) -> dict:
+        """
+        Returns the per sensor statistics as a dict of arrays
+        """
 
-    return f"    Max pressure: {max_pa:.3f}Pa\n    Min pressure: {min_pa:.3f}Pa\n    Avg pressure: {average_pa:.3f}Pa\n    {errors_msg}"
\ No newline at end of file
+        return {
+            "count": self.count,
+            "mean": self.mean.copy(),
+            "variance": self.variance(),
+            "min": self.min.copy(),
+            "max": self.max.copy(),
+        }
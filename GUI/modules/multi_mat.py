@@ -0,0 +1,305 @@
+"""
+Module responsible for recording several mats at once, eg when a floor is covered by more than one PMI.
+Every mat is read by its own AcquisitionEngine on its own thread, with its own port and calibration, and records its own
+session file. Frames are timestamped on arrival, and grouped into time aligned sets of one frame per mat for display
+and for recording to an aligned session file
+"""
+
+import threading
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+
+from modules.acquisition import *
+from modules.async_acquisition import AsyncAcquisitionLoop
+from modules.calibration import Calibration
+from modules.mat_handler import *
+from modules.session_file import SessionWriter, BackgroundSessionWriter, SESSION_FILE_EXTENSION, WRITE_QUEUE_SIZE, WRITE_POLICY_BLOCK
+
+ALIGNMENT_TOLERANCE_S = 0.02    # largest gap between a mat's frame and the time of its set before the mat counts as missing
+ALIGNMENT_HISTORY = 16          # number of recent frames of each mat kept to choose from when aligning
+ALIGNED_SESSION_FILE_NAME = "aligned" + SESSION_FILE_EXTENSION
+MAT_FOLDER_NAME = "mat_{index}"
+
+
+class MatConfig:
+    """
+    Class which describes one mat of a multi mat session
+    """
+
+    def __init__(self, port: str, baud: int=115200, calibrator: Calibration=None, name: str=None):
+        self.port = port
+        self.baud = baud
+        self.calibrator = calibrator
+        self.name = name if name is not None else port
+
+
+class MultiMatFrame:
+    """
+    Class which holds one time aligned set of frames, one per mat. frames[i] is None if mat i had no frame close enough
+    to timestamp_ns, and offsets_ns[i] is how long after timestamp_ns the frame of mat i arrived
+    """
+
+    def __init__(self, timestamp_ns: int, frames: list, offsets_ns: list):
+        self.timestamp_ns = timestamp_ns
+        self.frames = frames
+        self.offsets_ns = offsets_ns
+
+
+    def complete(self) -> bool:
+        """
+        Returns True if every mat has a frame in the set
+        """
+        return all(frame is not None for frame in self.frames)
+
+
+    def stacked(self, fill_value: float=np.nan) -> np.ndarray:
+        """
+        Returns the frames as one (mats, ROW_WIDTH, COL_HEIGHT) array, with missing frames filled with fill_value
+        """
+
+        shape = next((frame.shape for frame in self.frames if frame is not None), (ROW_WIDTH, COL_HEIGHT))
+        return np.stack([frame if frame is not None else np.full(shape, fill_value) for frame in self.frames])
+
+
+def tile_frames(frames: np.ndarray, columns: int) -> np.ndarray:
+    """
+    Lays a (mats, width, height) array of frames out side by side in rows of columns mats, as one 2D array for display
+    """
+
+    num_mats, width, height = frames.shape
+    rows = -(-num_mats // columns)
+
+    tiled = np.zeros((columns * width, rows * height), dtype=frames.dtype)
+    for i, frame in enumerate(frames):
+        column, row = i % columns, i // columns
+        tiled[column * width:(column + 1) * width, row * height:(row + 1) * height] = frame
+
+    return tiled
+
+
+class FrameAligner:
+    """
+    Class which groups frames from several mats, which arrive at their own rates, into time aligned sets.
+    A set is made once every mat has a frame that has not been used by a set yet. Its time is the oldest of the mats'
+    newest frames, and each mat contributes its unused frame closest to that time, or None if that frame is further away
+    than tolerance_ns. Sets are therefore made at the rate of the slowest mat, and no frame is used by more than one set
+    """
+
+    def __init__(self, num_mats: int, tolerance_ns: int=int(ALIGNMENT_TOLERANCE_S * 1000000000), history: int=ALIGNMENT_HISTORY):
+        self.num_mats = num_mats
+        self.tolerance_ns = tolerance_ns
+        self.frames = [deque(maxlen=history) for i in range(num_mats)]  # (arrival_ns, frame) of each mat, oldest first
+        self.last_used_ns = [-1] * num_mats     # arrival time of the newest frame of each mat used by a set
+
+        # statistics about the alignment
+        self.sets_made = 0
+        self.incomplete_sets = 0
+
+
+    def add(self, mat_index: int, arrival_ns: int, frame: np.ndarray) -> MultiMatFrame:
+        """
+        Adds a frame which arrived from a mat
+        returns: the new set if the frame completed one, otherwise None
+        """
+
+        self.frames[mat_index].append((arrival_ns, frame))
+
+        # wait until every mat has an unused frame
+        if any(not frames or frames[-1][0] <= last_used_ns for frames, last_used_ns in zip(self.frames, self.last_used_ns)):
+            return None
+
+        timestamp_ns = min(frames[-1][0] for frames in self.frames)
+        set_frames, offsets_ns = [], []
+
+        for i, frames in enumerate(self.frames):
+            t, f = min([(t, f) for t, f in frames if t > self.last_used_ns[i]], key=lambda candidate: abs(candidate[0] - timestamp_ns))
+
+            if abs(t - timestamp_ns) <= self.tolerance_ns:
+                set_frames.append(f)
+                offsets_ns.append(t - timestamp_ns)
+                self.last_used_ns[i] = t
+            else:
+                set_frames.append(None)
+                offsets_ns.append(None)
+
+        multi_mat_frame = MultiMatFrame(timestamp_ns, set_frames, offsets_ns)
+        self.sets_made += 1
+        if not multi_mat_frame.complete():
+            self.incomplete_sets += 1
+
+        return multi_mat_frame
+
+
+class MultiMatSession:
+    """
+    Class which records a session from several mats at once. Each mat's frames are recorded to a session file in its own
+    folder (mat_0, mat_1, ...) of the session folder, and the aligned sets of frames are recorded to
+    ALIGNED_SESSION_FILE_NAME as (mats, ROW_WIDTH, COL_HEIGHT) frames, with NaN for missing mats.
+    The newest set is published to sets_mailbox for display, and on_set(multi_mat_frame) is called for every set.
+    on_stats(message) is called with the live statistics of each mat, prefixed with its name, every stats_interval_s.
+    With async_io every mat is read from one asyncio event loop thread, rather than a thread per mat.
+    The session folder is path, or a new folder in sessions_folder, and is only created once start() has checked the ports
+    """
+
+    def __init__(self, mats: list, path=None, tolerance_s: float=ALIGNMENT_TOLERANCE_S, record_aligned: bool=True,
+                 write_queue_size: int=WRITE_QUEUE_SIZE, write_policy: str=WRITE_POLICY_BLOCK, record_raw: bool=False,
+                 on_set=None, on_stats=None, stats_interval_s: float=LIVE_STATS_INTERVAL_S, async_io: bool=False,
+                 mode: str=ACQUISITION_MODE_LOSSLESS, sessions_folder=SESSIONS_FOLDER):
+        self.mats = mats
+        self.path = Path(path) if path is not None else None
+        self.sessions_folder = sessions_folder
+        self.record_aligned = record_aligned
+        self.on_set = on_set
+        self.on_stats = on_stats
+        self.async_io = async_io
+
+        # settings of the engines, which are made by start()
+        self.engine_options = {
+            "write_queue_size": write_queue_size,
+            "write_policy": write_policy,
+            "record_raw": record_raw,
+            "mode": mode,
+            "stats_interval_s": stats_interval_s,
+        }
+
+        self.aligner = FrameAligner(len(mats), int(tolerance_s * 1000000000))
+        self.aligner_lock = threading.Lock()    # frames of every mat are added from their engine's thread
+        self.sets_mailbox = FrameMailbox()
+        self.aligned_file = None
+
+        self.engines = []
+        self.threads = []
+        self.async_loop = None
+
+
+    def frame_callback(self, mat_index: int):
+        """
+        Returns the on_frame callback for the engine of one mat
+        """
+
+        def on_frame(data_array, pressure_array, arrival_ns):
+            with self.aligner_lock:
+                multi_mat_frame = self.aligner.add(mat_index, arrival_ns, pressure_array)
+
+                # write sets in the order they were made
+                if multi_mat_frame is not None and self.aligned_file is not None:
+                    self.aligned_file.append(multi_mat_frame.stacked(), multi_mat_frame.timestamp_ns)
+
+            if multi_mat_frame is not None:
+                self.sets_mailbox.publish(multi_mat_frame)
+                if self.on_set is not None:
+                    self.on_set(multi_mat_frame)
+
+        return on_frame
+
+
+    def stats_callback(self, mat: MatConfig):
+        """
+        Returns the on_stats callback for the engine of one mat, which labels its statistics with the mat's name
+        """
+
+        def on_stats(message):
+            self.on_stats(f"== {mat.name} ==\n{message}")
+
+        return on_stats
+
+
+    def start(self):
+        """
+        Starts recording every mat, each on its own thread.
+        Raises ValueError, before any mat is started, if the port of a mat does not exist
+        """
+
+        missing_ports = [mat.port for mat in self.mats if not port_exists(mat.port)]
+        if missing_ports:
+            raise ValueError(f"Port(s) do not exist: {', '.join(missing_ports)}")
+
+        if self.path is None:
+            self.path = create_session_folder(self.sessions_folder)
+
+        for i, mat in enumerate(self.mats):
+            mat_path = self.path.joinpath(MAT_FOLDER_NAME.format(index=i))
+            mat_path.mkdir(parents=True, exist_ok=True)
+
+            engine = AcquisitionEngine(mat.port, mat.baud, mat.calibrator, path=mat_path, on_frame=self.frame_callback(i),
+                                       on_stats=self.stats_callback(mat) if self.on_stats is not None else None,
+                                       **self.engine_options)
+            self.engines.append(engine)
+
+        if self.record_aligned:
+            metadata = {
+                "mats": [{"name": mat.name, "port": mat.port, "baud": mat.baud} for mat in self.mats],
+                "units": "Pa",
+                "tolerance_ns": self.aligner.tolerance_ns,
+            }
+            writer = SessionWriter(self.path.joinpath(ALIGNED_SESSION_FILE_NAME), (len(self.mats), ROW_WIDTH, COL_HEIGHT),
+                                   np.float64, metadata=metadata, timestamps=True)
+            self.aligned_file = BackgroundSessionWriter(writer)
+
+        if self.async_io:
+            self.async_loop = AsyncAcquisitionLoop(self.engines)
+            self.async_loop.start()
+            return
+
+        for engine, mat in zip(self.engines, self.mats):
+            thread = threading.Thread(target=engine.run, name=f"AcquisitionThread-{mat.name}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+
+    def request_stop(self):
+        """
+        Asks every mat to stop without waiting for it, eg from a GUI thread which polls stopped() and then calls stop()
+        """
+
+        if self.async_loop is not None:
+            self.async_loop.request_stop()
+
+        for engine in self.engines:
+            engine.stop()
+
+
+    def stopped(self) -> bool:
+        """
+        Returns True once every mat has stopped and written out its session, so stop() will not block for long
+        """
+
+        if self.async_loop is not None:
+            return self.async_loop.stopped()
+        return not any(thread.is_alive() for thread in self.threads)
+
+
+    def stop(self):
+        """
+        Stops every mat, and waits for their sessions to be written out
+        """
+
+        if not self.stopped():
+            self.request_stop()
+
+        if self.async_loop is not None:
+            self.async_loop.stop()
+        for thread in self.threads:
+            thread.join()
+
+        if self.aligned_file is not None:
+            self.aligned_file.close()
+            self.aligned_file = None
+
+
+    def summary(self) -> str:
+        """
+        Returns the overall statistics of every mat and of the alignment as a formatted string
+        """
+
+        msg = ""
+        for i, (engine, mat) in enumerate(zip(self.engines, self.mats)):
+            msg += f"== {mat.name} ==\n{engine.summary()}"
+            if self.async_loop is not None:
+                msg += self.async_loop.readers[i].stats()
+            msg += "\n"
+
+        msg += f"Aligned sets: {self.aligner.sets_made} ({self.aligner.incomplete_sets} missing a mat)\n"
+        return msg
@@ -0,0 +1,158 @@
+"""
+Module responsible for serving the frames of recorded sessions to the GUI while scrubbing through them
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from modules.session_archive import open_session
+
+PLAYBACK_CACHE_SIZE = 512       # maximum number of decoded frames kept in memory
+PLAYBACK_PREFETCH_COUNT = 32    # number of frames read ahead in the direction the user is scrubbing
+
+
+class SessionPlayback:
+    """
+    Class which opens a session once and serves its frames from a bounded LRU cache.
+    A background thread fills the cache ahead of the most recently requested frame, in the direction the user is moving
+    """
+
+    def __init__(self, path, cache_size: int=PLAYBACK_CACHE_SIZE, prefetch_count: int=PLAYBACK_PREFETCH_COUNT):
+        self.reader = open_session(path)
+        self.cache_size = cache_size
+        self.prefetch_count = prefetch_count
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()    # guards the reader and the cache, which are shared with the prefetch thread
+
+        # statistics about the cache
+        self.hits = 0
+        self.misses = 0
+
+        # the prefetch thread waits on prefetch_condition for a new (index, direction) to read ahead of
+        self.last_index = None
+        self.prefetch_request = None
+        self.prefetch_condition = threading.Condition()
+        self.running = True
+        self.prefetch_thread = threading.Thread(target=self.prefetch_loop, name="PlaybackPrefetchThread", daemon=True)
+        self.prefetch_thread.start()
+
+
+    def __len__(self):
+        return len(self.reader)
+
+
+    def get(self, index: int) -> np.ndarray:
+        """
+        Returns the (calibrated) frame at index and starts prefetching the frames after it
+        """
+
+        with self.lock:
+            frame = self.cache.get(index)
+            if frame is not None:
+                self.cache.move_to_end(index)
+                self.hits += 1
+            else:
+                frame = self.load(index)
+                self.misses += 1
+
+        # read ahead in the direction the user is scrubbing
+        direction = -1 if self.last_index is not None and index < self.last_index else 1
+        self.last_index = index
+        with self.prefetch_condition:
+            self.prefetch_request = (index, direction)
+            self.prefetch_condition.notify()
+
+        return frame
+
+
+    def has_time_index(self) -> bool:
+        """
+        Returns True if the session was recorded with timestamps, so it can be navigated by time
+        """
+        return self.reader.has_time_index()
+
+
+    def time_offset_s(self, index: int) -> float:
+        """
+        Returns how many seconds after the first frame the frame at index arrived
+        """
+
+        with self.lock:
+            return self.reader.time_offset_s(index)
+
+
+    def seek_time(self, offset_s: float) -> int:
+        """
+        Returns the index of the frame being shown offset_s seconds after the first frame, found by binary search
+        """
+
+        with self.lock:
+            return self.reader.seek_time(offset_s)
+
+
+    def load(self, index: int) -> np.ndarray:
+        """
+        Reads a frame into the cache, evicting the least recently used frames. self.lock must be held
+        """
+
+        frame = np.array(self.reader[index])    # copy out of any memory map so the cache owns the frame
+        frame.flags.writeable = False
+
+        self.cache[index] = frame
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return frame
+
+
+    def prefetch_loop(self):
+        """
+        Main loop of the prefetch thread
+        """
+
+        while True:
+            with self.prefetch_condition:
+                while self.running and self.prefetch_request is None:
+                    self.prefetch_condition.wait()
+                if not self.running:
+                    return
+                start, direction = self.prefetch_request
+                self.prefetch_request = None
+
+            for step in range(1, self.prefetch_count + 1):
+                index = start + step * direction
+                if not 0 <= index < len(self.reader):
+                    break
+
+                # stop as soon as the user has moved somewhere else
+                if self.prefetch_request is not None or not self.running:
+                    break
+
+                with self.lock:
+                    if index not in self.cache:
+                        self.load(index)
+
+
+    def set_calibrator(self, calibrator):
+        """
+        Sets the Calibration used to convert the frames of a raw session to pressures, throwing away frames calibrated with the old one
+        """
+
+        with self.lock:
+            self.reader.set_calibrator(calibrator)
+            self.cache.clear()
+
+
+    def close(self):
+        """
+        Stops the prefetch thread and closes the session
+        """
+
+        with self.prefetch_condition:
+            self.running = False
+            self.prefetch_condition.notify()
+        self.prefetch_thread.join()
+
+        self.reader.close()
@@ -0,0 +1,97 @@
+"""
+Module responsible for converting arrays of pressure values into images
+"""
+
+import numpy as np
+
+from PyQt6.QtGui import QImage
+
+COLORMAP_SIZE = 256     # pressures are quantized to this many levels before being mapped to colors
+
+# colormaps are defined by evenly spaced RGB anchor colors, which are interpolated into COLORMAP_SIZE entries
+COLORMAP_ANCHORS = {
+    "grayscale": [(0, 0, 0), (255, 255, 255)],
+    "heat": [(0, 0, 0), (128, 0, 0), (255, 64, 0), (255, 192, 0), (255, 255, 255)],
+    "jet": [(0, 0, 128), (0, 0, 255), (0, 255, 255), (255, 255, 0), (255, 0, 0), (128, 0, 0)],
+    "viridis": [(68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)],
+}
+DEFAULT_COLORMAP = "grayscale"
+
+
+def build_colormap(name: str) -> np.ndarray:
+    """
+    Returns the (COLORMAP_SIZE, 3) uint8 color table of the named colormap
+    """
+
+    anchors = np.asarray(COLORMAP_ANCHORS[name], dtype=np.double)
+    anchor_positions = np.linspace(0, COLORMAP_SIZE - 1, len(anchors))
+    levels = np.arange(COLORMAP_SIZE)
+
+    table = np.stack([np.interp(levels, anchor_positions, anchors[:, channel]) for channel in range(3)], axis=1)
+    return np.round(table).astype(np.uint8)
+
+
+class PressureRenderer:
+    """
+    Class which converts pressure arrays into RGB images by quantizing them and looking the levels up in a colormap.
+    All buffers are allocated once per shape of pressure array, so rendering a frame does not allocate any arrays
+    """
+
+    def __init__(self, shape: tuple, max_pressure: float, colormap: str=DEFAULT_COLORMAP):
+        self.max_pressure = max_pressure
+        self.resize(shape)
+        self.set_colormap(colormap)
+
+
+    def resize(self, shape: tuple):
+        """
+        Allocates the buffers for pressure arrays of a new shape, eg the tiled frames of several mats
+        """
+
+        self.shape = tuple(shape)
+        self.scaled = np.empty(self.shape, dtype=np.double)
+        self.levels = np.empty(self.shape, dtype=np.uint8)
+        self.rgb = np.empty((*self.shape, 3), dtype=np.uint8)
+
+
+    def set_colormap(self, colormap: str):
+        """
+        Selects one of the colormaps in COLORMAP_ANCHORS
+        """
+
+        self.colormap_name = colormap
+        self.colormap = build_colormap(colormap)
+
+
+    def colorize(self, pressure_array: np.ndarray) -> np.ndarray:
+        """
+        Converts an array of pressure values to RGB colors. The returned array is reused by the next call
+        """
+
+        if pressure_array.shape != self.shape:
+            self.resize(pressure_array.shape)
+
+        # quantize the pressures to colormap levels, with 0 Pa at the bottom of the colormap and max_pressure at the top
+        np.divide(pressure_array, self.max_pressure, out=self.scaled)
+        np.multiply(self.scaled, COLORMAP_SIZE - 1, out=self.scaled)
+        np.clip(self.scaled, 0, COLORMAP_SIZE - 1, out=self.scaled)
+        np.copyto(self.levels, self.scaled, casting='unsafe')
+
+        # look each level up in the colormap
+        np.take(self.colormap, self.levels, axis=0, out=self.rgb)
+        return self.rgb
+
+
+    def render(self, pressure_array: np.ndarray) -> QImage:
+        """
+        Converts an array of pressure values to a QImage. The image shares its memory with a buffer that is reused by
+        the next call, so it must be drawn (eg converted to a QPixmap) before rendering again
+        """
+
+        rgb = self.colorize(pressure_array)
+        height, width = rgb.shape[:2]
+
+        # convert the numpy array directly to an image in memory. See these resources:
+        #   https://stackoverflow.com/questions/34232632/convert-python-opencv-image-numpy-array-to-pyqt-qpixmap-image
+        #   https://copyprogramming.com/howto/pyqt5-convert-2d-np-array-to-qimage
+        return QImage(rgb.data, width, height, width * 3, QImage.Format.Format_RGB888)
@@ -0,0 +1,234 @@
+"""
+Module responsible for compressed archives of recorded sessions, for long term storage
+
+An archive groups frames into chunks of up to chunk_size frames. Within a chunk, every frame after the first is
+stored as its difference from the previous frame (on the integer bit pattern of the frames, so it is lossless for
+any dtype), which is mostly zeros as the mat is usually at rest. Each chunk is then compressed on its own with the
+codec named in the header, so any frame can be decoded by reading just its chunk:
+    ARCHIVE_MAGIC | header length | json header | padding | chunk 0 | chunk 1 | ... | chunk index | footer
+The chunk index is a little endian uint64 array of the offset of every chunk plus the end of the last one, and the
+footer holds the offset of the index, the number of frames and ARCHIVE_MAGIC again.
+Archives of sessions with a time index set "timestamps" in the header, and store the time index (see session_file.py)
+uncompressed between the chunk index and the footer, so it can be searched without decoding any frames.
+"""
+
+import lzma, struct, zlib
+from pathlib import Path
+
+import numpy as np
+
+from modules.session_file import *
+
+ARCHIVE_MAGIC = b"PMATARCH"
+ARCHIVE_EXTENSION = ".pmatz"
+ARCHIVE_CHUNK_SIZE = 256    # default number of frames per chunk
+ARCHIVE_CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+FOOTER_FORMAT = "<QQ"   # offset of the chunk index, number of frames
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT) + len(ARCHIVE_MAGIC)
+
+
+def delta_encode(frames: np.ndarray) -> np.ndarray:
+    """
+    Replaces every frame of a (frames, ...) array after the first with its difference from the previous frame
+    """
+
+    ints = frames.view(np.dtype(f"<u{frames.dtype.itemsize}"))
+    deltas = ints.copy()
+    deltas[1:] -= ints[:-1]     # unsigned arithmetic wraps around, so this can always be undone exactly
+    return deltas
+
+
+def delta_decode(deltas: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """
+    Undoes delta_encode
+    """
+
+    return np.cumsum(deltas, axis=0, dtype=deltas.dtype).view(dtype)
+
+
+class SessionArchiveWriter:
+    """
+    Class which writes frames to a chunked, delta encoded and compressed session archive
+    """
+
+    def __init__(self, path, shape: tuple, dtype=np.float64, metadata: dict=None, chunk_size: int=ARCHIVE_CHUNK_SIZE,
+                 codec: str="zlib", timestamps: bool=False):
+        if codec not in ARCHIVE_CODECS:
+            raise ValueError(f"Unknown codec {codec}, expected one of {list(ARCHIVE_CODECS)}")
+
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.compress = ARCHIVE_CODECS[codec][0]
+        self.frame_count = 0
+        self.chunk = []
+        self.chunk_offsets = []
+        self.timestamps_ns = [] if timestamps else None
+
+        self.file = open(path, "wb")
+        write_session_header(self.file, ARCHIVE_MAGIC, self.shape, self.dtype, metadata if metadata is not None else {},
+                             extra={"chunk_size": chunk_size, "codec": codec, "timestamps": timestamps})
+
+
+    def append(self, frame: np.ndarray, timestamp_ns: int=None):
+        """
+        Adds one frame (and its timestamp if the archive has a time index) to the archive, writing out the current chunk once it is full
+        """
+
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame of shape {frame.shape} does not match the archive's shape {self.shape}")
+        if self.timestamps_ns is not None and timestamp_ns is None:
+            raise ValueError("Frames of an archive with a time index must have a timestamp")
+
+        self.chunk.append(np.asarray(frame, dtype=self.dtype))
+        self.frame_count += 1
+        if self.timestamps_ns is not None:
+            self.timestamps_ns.append(timestamp_ns)
+
+        if len(self.chunk) == self.chunk_size:
+            self.write_chunk()
+
+
+    def write_chunk(self):
+        """
+        Delta encodes, compresses and writes the current chunk
+        """
+
+        if not self.chunk:
+            return
+
+        self.chunk_offsets.append(self.file.tell())
+        self.file.write(self.compress(delta_encode(np.stack(self.chunk)).tobytes()))
+        self.chunk = []
+
+
+    def close(self):
+        """
+        Writes the last chunk, the chunk index and the footer, then closes the archive
+        """
+
+        if self.file.closed:
+            return
+
+        self.write_chunk()
+
+        index_offset = self.file.tell()
+        self.file.write(np.asarray(self.chunk_offsets + [index_offset], dtype="<u8").tobytes())
+        if self.timestamps_ns is not None:
+            self.file.write(np.asarray(self.timestamps_ns, dtype=TIME_INDEX_DTYPE).tobytes())
+        self.file.write(struct.pack(FOOTER_FORMAT, index_offset, self.frame_count))
+        self.file.write(ARCHIVE_MAGIC)
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SessionArchiveReader(BaseSessionReader):
+    """
+    Class which reads frames from a session archive. Only the chunk holding a frame is read and decoded,
+    and the last decoded chunk is kept so that stepping through neighbouring frames is cheap
+    """
+
+    def __init__(self, path):
+        header, data_offset = read_session_header(path, ARCHIVE_MAGIC)
+        super(SessionArchiveReader, self).__init__(path, header)
+        self.chunk_size = self.header["chunk_size"]
+        self.decompress = ARCHIVE_CODECS[self.header["codec"]][1]
+
+        self.file = open(path, "rb")
+        self.file.seek(-FOOTER_SIZE, 2)
+        footer = self.file.read(FOOTER_SIZE)
+        if footer[-len(ARCHIVE_MAGIC):] != ARCHIVE_MAGIC:
+            raise ValueError(f"{path} is not a complete session archive")
+
+        index_offset, self.frame_count = struct.unpack(FOOTER_FORMAT, footer[:struct.calcsize(FOOTER_FORMAT)])
+        num_chunks = -(-self.frame_count // self.chunk_size)
+        self.file.seek(index_offset)
+        self.chunk_offsets = np.frombuffer(self.file.read((num_chunks + 1) * 8), dtype="<u8")
+        if self.header.get("timestamps", False):
+            self.timestamps_ns = np.frombuffer(self.file.read(self.frame_count * TIME_INDEX_DTYPE.itemsize), dtype=TIME_INDEX_DTYPE)
+
+        self.cached_chunk_index = None
+        self.cached_chunk = None
+
+
+    def read_chunk(self, chunk_index: int) -> np.ndarray:
+        """
+        Reads and decodes one chunk of frames
+        """
+
+        if chunk_index != self.cached_chunk_index:
+            start, end = self.chunk_offsets[chunk_index], self.chunk_offsets[chunk_index + 1]
+            self.file.seek(int(start))
+            data = self.decompress(self.file.read(int(end - start)))
+
+            deltas = np.frombuffer(data, dtype=np.dtype(f"<u{self.dtype.itemsize}")).reshape(-1, *self.shape)
+            self.cached_chunk = delta_decode(deltas, self.dtype)
+            self.cached_chunk.flags.writeable = False
+            self.cached_chunk_index = chunk_index
+
+        return self.cached_chunk
+
+
+    def read_frames(self, index) -> np.ndarray:
+        if isinstance(index, slice):
+            return np.stack([self.read_frames(i) for i in range(*index.indices(len(self)))])
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Frame {index} is out of range for an archive of {len(self)} frames")
+
+        return self.read_chunk(index // self.chunk_size)[index % self.chunk_size]
+
+
+    def __len__(self):
+        return self.frame_count
+
+
+    def close(self):
+        self.file.close()
+
+
+def archive_session(session_path, archive_path=None, chunk_size: int=ARCHIVE_CHUNK_SIZE, codec: str="zlib"):
+    """
+    Compresses a session file into a session archive, by default next to it with ARCHIVE_EXTENSION
+    returns: the path of the archive
+    """
+
+    if archive_path is None:
+        archive_path = Path(session_path).with_suffix(ARCHIVE_EXTENSION)
+
+    reader = SessionReader(session_path)
+    try:
+        with SessionArchiveWriter(archive_path, reader.shape, reader.dtype, reader.metadata, chunk_size, codec,
+                                  reader.has_time_index()) as writer:
+            for i in range(len(reader)):
+                writer.append(reader.read_frames(i), int(reader.timestamps_ns[i]) if reader.has_time_index() else None)
+    finally:
+        reader.close()
+
+    return archive_path
+
+
+def open_session(path) -> BaseSessionReader:
+    """
+    Opens a session file, session archive or one .npy file of an older session's folder for reading, based on its extension
+    """
+
+    if str(path).endswith(ARCHIVE_EXTENSION):
+        return SessionArchiveReader(path)
+    if str(path).endswith(".npy"):
+        return NpyFolderReader(Path(path).parent)
+    return SessionReader(path)
@@ -0,0 +1,552 @@
+"""
+Module responsible for storing the frames of a recording session in a single append-only file
+
+A session file is a small header followed by fixed size frame records:
+    SESSION_FILE_MAGIC | header length (uint32, little endian) | json header | padding | frame 0 | frame 1 | ...
+The json header holds the shape and dtype of the frames and any metadata about the session (eg calibration).
+The number of frames is not stored, it is calculated from the size of the file so frames can simply be appended.
+Raw sessions store the uint8 mat readings along with a snapshot of the calibration (see Calibration.snapshot()),
+and are converted to pressures when they are read.
+
+Sessions written with timestamps have a time index next to the session file (see time_index_path()): the
+time.monotonic_ns() each frame arrived at the host, as one little endian int64 per frame. Monotonic times never
+decrease, so the index is sorted and frames can be found by time with a binary search.
+"""
+
+import abc, json, os, struct, threading, queue
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+
+SESSION_FILE_MAGIC = b"PMATSESS"
+SESSION_FILE_VERSION = 1
+SESSION_FILE_EXTENSION = ".pmat"
+SESSION_FILE_NAME = "session" + SESSION_FILE_EXTENSION
+SESSION_FILE_ALIGNMENT = 64             # frame data starts on a multiple of this many bytes
+SESSION_FILE_BUFFER_SIZE = 1024 * 1024  # size of the write buffer in bytes
+
+HEADER_LENGTH_FORMAT = "<I"
+
+TIME_INDEX_EXTENSION = ".ptime"
+TIME_INDEX_DTYPE = np.dtype("<i8")
+
+# what a BackgroundSessionWriter does with a frame when its queue is full
+WRITE_POLICY_BLOCK = "block"                # wait for the writer thread to make room
+WRITE_POLICY_DROP_OLDEST = "drop_oldest"    # throw away the oldest queued frame to make room
+WRITE_POLICY_SPILL = "spill"                # keep the frame in an overflow list until the writer catches up
+WRITE_POLICIES = (WRITE_POLICY_BLOCK, WRITE_POLICY_DROP_OLDEST, WRITE_POLICY_SPILL)
+WRITE_QUEUE_SIZE = 256                      # default number of frames that can wait to be written
+WRITE_SPILL_LIMIT = 8192                    # default number of frames the overflow list holds, ~100MB of pressure frames
+
+
+def time_index_path(path) -> Path:
+    """
+    Returns the path of the time index of a session file or archive
+    """
+    return Path(path).with_suffix(TIME_INDEX_EXTENSION)
+
+
+class SessionWriter:
+    """
+    Class which appends frames of a fixed shape and dtype to a session file using buffered writes.
+    With timestamps, the time of every frame is appended to the session's time index as well
+    """
+
+    def __init__(self, path, shape: tuple, dtype=np.float64, metadata: dict=None, timestamps: bool=False):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.metadata = metadata if metadata is not None else {}
+        self.frame_count = 0
+        self.last_timestamp_ns = None
+
+        self.file = open(path, "wb", buffering=SESSION_FILE_BUFFER_SIZE)
+        write_session_header(self.file, SESSION_FILE_MAGIC, self.shape, self.dtype, self.metadata)
+        self.time_file = open(time_index_path(path), "wb") if timestamps else None
+
+
+    def append(self, frame: np.ndarray, timestamp_ns: int=None):
+        """
+        Appends one frame to the end of the session file, along with the time.monotonic_ns() it arrived if the session
+        has a time index
+        returns: the index of the appended frame
+        """
+
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame of shape {frame.shape} does not match the session's shape {self.shape}")
+
+        if self.time_file is not None:
+            if timestamp_ns is None:
+                raise ValueError("Frames of a session with a time index must have a timestamp")
+            if self.last_timestamp_ns is not None and timestamp_ns < self.last_timestamp_ns:
+                raise ValueError(f"Timestamp {timestamp_ns} is older than the previous frame's {self.last_timestamp_ns}")
+
+        self.file.write(np.ascontiguousarray(frame, dtype=self.dtype).data)
+        self.frame_count += 1
+
+        if self.time_file is not None:
+            self.time_file.write(struct.pack("<q", timestamp_ns))
+            self.last_timestamp_ns = timestamp_ns
+
+        return self.frame_count - 1
+
+
+    def flush(self):
+        """
+        Writes any buffered frames to disk
+        """
+        self.file.flush()
+        if self.time_file is not None:
+            self.time_file.flush()
+
+
+    def close(self):
+        """
+        Flushes and closes the session file
+        """
+        if not self.file.closed:
+            self.file.close()
+        if self.time_file is not None and not self.time_file.closed:
+            self.time_file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_session_header(file, magic: bytes, shape: tuple, dtype: np.dtype, metadata: dict, extra: dict=None):
+    """
+    Writes magic, the header length and the json header to an open file, padding the header so that the data after it is aligned.
+    extra holds any additional header fields specific to the file format
+    """
+
+    header = {
+        "version": SESSION_FILE_VERSION,
+        "shape": list(shape),
+        "dtype": dtype.str,
+        "metadata": metadata,
+    }
+    if extra is not None:
+        header.update(extra)
+    header_bytes = json.dumps(header).encode('utf-8')
+
+    # pad the header with spaces so that the frame data is aligned
+    prefix_size = len(magic) + struct.calcsize(HEADER_LENGTH_FORMAT)
+    padding = -(prefix_size + len(header_bytes)) % SESSION_FILE_ALIGNMENT
+    header_bytes += b" " * padding
+
+    file.write(magic)
+    file.write(struct.pack(HEADER_LENGTH_FORMAT, len(header_bytes)))
+    file.write(header_bytes)
+
+
+def read_session_header(path, magic: bytes=SESSION_FILE_MAGIC) -> tuple:
+    """
+    Reads the header of a session file
+    returns: the header as a dict, and the offset in bytes of the first frame
+    """
+
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{path} is not a session file")
+
+        (header_length,) = struct.unpack(HEADER_LENGTH_FORMAT, f.read(struct.calcsize(HEADER_LENGTH_FORMAT)))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+
+        if header["version"] > SESSION_FILE_VERSION:
+            raise ValueError(f"{path} has unsupported session file version {header['version']}")
+
+        return header, f.tell()
+
+
+class BaseSessionReader(abc.ABC):
+    """
+    Abstract base class for reading the frames of a recorded session. Subclasses set the header and implement __len__ and read_frames()
+    """
+
+    def __init__(self, path, header: dict):
+        self.path = path
+        self.header = header
+        self.shape = tuple(self.header["shape"])
+        self.dtype = np.dtype(self.header["dtype"])
+        self.metadata = self.header["metadata"]
+        self.raw = self.metadata.get("raw", False)
+        self.calibrator = None
+        self.timestamps_ns = None   # the time index, set by subclasses if the session has one
+
+
+    def set_calibrator(self, calibrator):
+        """
+        Sets the Calibration used to convert the frames of a raw session to pressures when they are read
+        """
+        self.calibrator = calibrator
+
+
+    def calibration_snapshot(self) -> dict:
+        """
+        Returns the snapshot of the calibration that was active when a raw session was recorded, or None
+        """
+        return self.metadata.get("calibration")
+
+
+    def calibrate(self, raw_frame: np.ndarray) -> np.ndarray:
+        """
+        Converts one raw frame to pressures using the calibrator
+        """
+        return self.calibrator.apply_dc_offsets(self.calibrator.apply_calibration_curve(raw_frame))
+
+
+    @abc.abstractmethod
+    def read_frames(self, index) -> np.ndarray:
+        """
+        Returns the stored frame(s) at index (an int or slice) without calibrating them
+        """
+
+
+    def has_time_index(self) -> bool:
+        """
+        Returns True if the session was recorded with timestamps
+        """
+        return self.timestamps_ns is not None
+
+
+    def require_time_index(self):
+        """
+        Raises a ValueError if the session was recorded without timestamps
+        """
+
+        if self.timestamps_ns is None:
+            raise ValueError(f"{self.path} has no time index, so its frames can only be found by index")
+
+
+    def time_offset_s(self, index: int) -> float:
+        """
+        Returns how many seconds after the first frame the frame at index arrived
+        """
+
+        self.require_time_index()
+        return (int(self.timestamps_ns[index]) - int(self.timestamps_ns[0])) / 1000000000
+
+
+    def seek_time(self, offset_s: float) -> int:
+        """
+        Finds the frame being shown offset_s seconds after the first frame, ie the last frame which arrived at or before
+        then, with a binary search of the time index. Of several frames which arrived at the same time the first is
+        returned, so seek_time(time_offset_s(i)) finds frame i or the first frame with its time
+        returns: the index of the frame, clamped to the session
+        """
+
+        self.require_time_index()
+        if len(self) == 0:
+            raise IndexError(f"{self.path} has no frames")
+
+        target_ns = int(self.timestamps_ns[0]) + int(round(offset_s * 1000000000))
+        index = min(max(int(np.searchsorted(self.timestamps_ns, target_ns, side='right')) - 1, 0), len(self) - 1)
+        return int(np.searchsorted(self.timestamps_ns, self.timestamps_ns[index], side='left'))
+
+
+    def time_slice(self, start_s: float, end_s: float) -> slice:
+        """
+        Returns the slice of the frames which arrived from start_s up to (but not including) end_s seconds after the
+        first frame, found with binary searches of the time index
+        """
+
+        self.require_time_index()
+        if len(self) == 0:
+            return slice(0, 0)
+
+        first_ns = int(self.timestamps_ns[0])
+        start, end = np.searchsorted(self.timestamps_ns, [first_ns + int(round(start_s * 1000000000)),
+                                                          first_ns + int(round(end_s * 1000000000))], side='left')
+        return slice(int(start), int(end))
+
+
+    @abc.abstractmethod
+    def __len__(self):
+        """
+        Returns the number of frames in the session
+        """
+
+
+    def close(self):
+        """
+        Releases any files held open by the reader
+        """
+        pass
+
+
+    def __getitem__(self, index):
+        frames = self.read_frames(index)
+
+        if not self.raw or self.calibrator is None:
+            return frames
+
+        if frames.ndim == len(self.shape):
+            return self.calibrate(frames)
+        return np.stack([self.calibrate(frame) for frame in frames])
+
+
+class SessionReader(BaseSessionReader):
+    """
+    Class which reads the frames of a session file through a read only memory map
+    """
+
+    def __init__(self, path):
+        header, self.data_offset = read_session_header(path)
+        super(SessionReader, self).__init__(path, header)
+        self.frames = None
+        self.refresh()
+
+
+    def refresh(self):
+        """
+        Re-maps the file and its time index, picking up any frames appended since it was opened.
+        A partially written last frame, or one whose timestamp has not been written yet, is ignored
+        returns: the number of frames in the session
+        """
+
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        with open(self.path, "rb") as f:
+            f.seek(0, 2)
+            frame_count = (f.tell() - self.data_offset) // frame_bytes
+
+        times_path = time_index_path(self.path)
+        if times_path.exists():
+            frame_count = min(frame_count, times_path.stat().st_size // TIME_INDEX_DTYPE.itemsize)
+            if frame_count > 0:
+                self.timestamps_ns = np.memmap(times_path, dtype=TIME_INDEX_DTYPE, mode='r', shape=(frame_count,))
+            else:
+                self.timestamps_ns = np.empty(0, dtype=TIME_INDEX_DTYPE)
+
+        if frame_count > 0:
+            self.frames = np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.data_offset, shape=(frame_count, *self.shape))
+        else:
+            self.frames = np.empty((0, *self.shape), dtype=self.dtype)
+
+        return frame_count
+
+
+    def read_frames(self, index) -> np.ndarray:
+        return self.frames[index]
+
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+
+    def close(self):
+        """
+        Drops the memory maps of the file and its time index
+        """
+        self.frames = np.empty((0, *self.shape), dtype=self.dtype)
+        if self.timestamps_ns is not None:
+            self.timestamps_ns = np.empty(0, dtype=TIME_INDEX_DTYPE)
+
+
+class NpyFolderReader(BaseSessionReader):
+    """
+    Class which reads sessions recorded by older versions of the GUI, which saved each frame as a numbered .npy file in the session folder
+    """
+
+    def __init__(self, folder):
+        # list the folder once, rather than every time the frame count is needed
+        self.files = sorted(entry.path for entry in os.scandir(folder) if entry.is_file() and entry.name.endswith(".npy"))
+        if not self.files:
+            raise ValueError(f"{folder} does not contain any .npy files")
+
+        first_frame = np.load(self.files[0], allow_pickle=False)
+        header = {"shape": list(first_frame.shape), "dtype": first_frame.dtype.str, "metadata": {}}
+        super(NpyFolderReader, self).__init__(folder, header)
+
+
+    def read_frames(self, index) -> np.ndarray:
+        if isinstance(index, slice):
+            return np.stack([np.load(path, allow_pickle=False) for path in self.files[index]])
+        return np.load(self.files[index], allow_pickle=False)
+
+
+    def __len__(self):
+        return len(self.files)
+
+
+class BackgroundSessionWriter:
+    """
+    Class which appends frames to a SessionWriter from a dedicated thread, so that slow disk writes never stall the caller.
+    Frames are passed through a bounded queue, and policy decides what happens when it is full (see WRITE_POLICIES).
+    The overflow list of WRITE_POLICY_SPILL is bounded too: once it holds spill_limit frames, new frames are dropped
+    (and counted in frames_dropped) until the writer catches up, so a long disk stall can not use up all memory.
+    Appended frames must not be modified afterwards, as they are written later
+    """
+
+    def __init__(self, writer: SessionWriter, queue_size: int=WRITE_QUEUE_SIZE, policy: str=WRITE_POLICY_BLOCK,
+                 spill_limit: int=WRITE_SPILL_LIMIT):
+        if policy not in WRITE_POLICIES:
+            raise ValueError(f"Unknown write policy {policy}, expected one of {WRITE_POLICIES}")
+
+        self.writer = writer
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflow = deque()
+        self.spill_limit = spill_limit
+        self.overflow_lock = threading.Lock()
+        self.error = None
+
+        # statistics about the writer
+        self.frames_appended = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.frames_spilled = 0
+        self.max_queue_depth = 0
+
+        self.thread = threading.Thread(target=self.write_loop, name="SessionWriterThread", daemon=True)
+        self.thread.start()
+
+
+    def append(self, frame: np.ndarray, timestamp_ns: int=None):
+        """
+        Queues one frame, and its timestamp if the session has a time index, to be appended to the session file
+        """
+
+        # frames and their timestamps travel together, so a dropped frame takes its timestamp with it
+        item = (frame, timestamp_ns)
+
+        with self.overflow_lock:
+            # once frames have spilled, later frames must follow them to keep the session in order
+            spilling = len(self.overflow) > 0
+
+            if spilling:
+                self.spill(item)
+
+        if not spilling:
+            if self.policy == WRITE_POLICY_BLOCK:
+                self.queue.put(item)
+            else:
+                try:
+                    self.queue.put_nowait(item)
+                except queue.Full:
+                    if self.policy == WRITE_POLICY_DROP_OLDEST:
+                        try:
+                            self.queue.get_nowait()
+                            self.frames_dropped += 1
+                        except queue.Empty:
+                            pass
+                        self.queue.put_nowait(item)
+                    else:
+                        with self.overflow_lock:
+                            self.spill(item)
+
+        self.frames_appended += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+
+
+    def spill(self, item: tuple):
+        """
+        Adds a frame to the overflow list, or drops it if the list is full. Must be called with overflow_lock held
+        """
+
+        if len(self.overflow) >= self.spill_limit:
+            self.frames_dropped += 1
+            return
+
+        self.overflow.append(item)
+        self.frames_spilled += 1
+
+
+    def queue_depth(self) -> int:
+        """
+        Returns the number of frames waiting to be written
+        """
+        return self.queue.qsize() + len(self.overflow)
+
+
+    def write_loop(self):
+        """
+        Main loop of the writer thread. Writes queued frames until the None sentinel is received
+        """
+
+        while True:
+            # spilled frames are always newer than everything in the queue, so only write them once it is empty
+            if self.queue.empty() and len(self.overflow) > 0:
+                with self.overflow_lock:
+                    items = list(self.overflow)
+                    self.overflow.clear()
+            else:
+                items = [self.queue.get()]
+
+            for item in items:
+                if item is None:
+                    self.write_overflow()
+                    return
+                self.write(*item)
+
+
+    def write_overflow(self):
+        """
+        Writes any frames left in the overflow list
+        """
+
+        with self.overflow_lock:
+            items = list(self.overflow)
+            self.overflow.clear()
+
+        for item in items:
+            self.write(*item)
+
+
+    def write(self, frame: np.ndarray, timestamp_ns: int=None):
+        """
+        Writes one frame, remembering the first error so it can be raised to the caller
+        """
+
+        if self.error is not None:
+            return
+
+        try:
+            self.writer.append(frame, timestamp_ns)
+            self.frames_written += 1
+        except Exception as e:
+            print(f"Failed to write to the session file: {e}")
+            self.error = e
+
+
+    def stats(self) -> dict:
+        """
+        Returns statistics about the writer
+        """
+
+        return {
+            "queue_depth": self.queue_depth(),
+            "max_queue_depth": self.max_queue_depth,
+            "frames_written": self.frames_written,
+            "frames_dropped": self.frames_dropped,
+            "frames_spilled": self.frames_spilled,
+        }
+
+
+    def close(self):
+        """
+        Writes every queued frame, then closes the session file. Raises the first write error, if there was one
+        """
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+        self.writer.close()
+
+        if self.error is not None:
+            raise self.error
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,172 @@
+"""
+Module responsible for statistics about a recording session which are kept in a fixed amount of memory, however long it runs
+"""
+
+import json, math
+from collections import deque
+
+import numpy as np
+
+# latency histograms have LATENCY_BUCKETS_PER_DECADE logarithmically spaced buckets per power of ten from LATENCY_MIN_NS
+# to LATENCY_MAX_NS, plus one bucket each for anything below or above that range
+LATENCY_MIN_NS = 100
+LATENCY_MAX_NS = 100 * 1000000000
+LATENCY_BUCKETS_PER_DECADE = 20     # each bucket is about 12% wider than the last
+LATENCY_PERCENTILES = (50, 95, 99)
+
+RECENT_INTERVALS = 64   # number of the most recent intervals between frames the live sample rate is averaged over
+
+
+class LatencyHistogram:
+    """
+    Class which counts durations in nanoseconds into fixed, logarithmically spaced buckets, so that percentiles can be
+    estimated to within a bucket's width without storing every duration
+    """
+
+    def __init__(self):
+        self.num_buckets = int(round(math.log10(LATENCY_MAX_NS / LATENCY_MIN_NS) * LATENCY_BUCKETS_PER_DECADE)) + 2
+        self.counts = [0] * self.num_buckets
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+
+    def record(self, duration_ns: int):
+        """
+        Adds one duration to the histogram
+        """
+
+        if duration_ns < LATENCY_MIN_NS:
+            bucket = 0
+        else:
+            bucket = min(int(math.log10(duration_ns / LATENCY_MIN_NS) * LATENCY_BUCKETS_PER_DECADE) + 1, self.num_buckets - 1)
+
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+
+    def bucket_upper_edges_ns(self) -> np.ndarray:
+        """
+        Returns the largest duration counted by each bucket. The last bucket has no upper limit, so max_ns is used
+        """
+
+        edges = LATENCY_MIN_NS * 10 ** (np.arange(self.num_buckets) / LATENCY_BUCKETS_PER_DECADE)
+        edges[-1] = max(edges[-1], self.max_ns)
+        return edges
+
+
+    def percentile(self, q: float) -> float:
+        """
+        Returns an estimate of the q-th percentile duration in nanoseconds: the upper edge of the bucket it falls in
+        """
+
+        if self.count == 0:
+            return 0.0
+
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.count))
+        return float(min(self.bucket_upper_edges_ns()[bucket], self.max_ns))
+
+
+    def mean_ns(self) -> float:
+        return self.total_ns / self.count if self.count else 0.0
+
+
+    def format(self) -> str:
+        """
+        Returns the percentiles and maximum of the histogram in microseconds, formatted as p50/p95/p99/max
+        """
+
+        values = [self.percentile(q) for q in LATENCY_PERCENTILES] + [self.max_ns]
+        return "/".join(f"{value / 1000:.0f}" for value in values)
+
+
+    def data(self) -> dict:
+        """
+        Returns the full histogram as a json serializable dict
+        """
+
+        return {
+            "count": self.count,
+            "mean_ns": self.mean_ns(),
+            "max_ns": self.max_ns,
+            **{f"p{q}_ns": self.percentile(q) for q in LATENCY_PERCENTILES},
+            "bucket_upper_edges_ns": self.bucket_upper_edges_ns().tolist(),
+            "counts": list(self.counts),
+        }
+
+
+class IntervalStats:
+    """
+    Class which keeps statistics about the intervals between frames in constant memory: a streaming mean and variance
+    (Welford's algorithm), a LatencyHistogram of every interval, and a ring buffer of the most recent intervals
+    """
+
+    def __init__(self, recent_size: int=RECENT_INTERVALS):
+        self.count = 0
+        self.mean_ns = 0.0
+        self.m2 = 0.0       # sum of squared differences from the mean
+        self.histogram = LatencyHistogram()
+        self.recent = deque(maxlen=recent_size)
+        self.recent_total_ns = 0
+
+
+    def record(self, interval_ns: int):
+        """
+        Adds the interval between two frames
+        """
+
+        self.count += 1
+        delta = interval_ns - self.mean_ns
+        self.mean_ns += delta / self.count
+        self.m2 += delta * (interval_ns - self.mean_ns)
+
+        self.histogram.record(interval_ns)
+
+        if len(self.recent) == self.recent.maxlen:
+            self.recent_total_ns -= self.recent[0]
+        self.recent.append(interval_ns)
+        self.recent_total_ns += interval_ns
+
+
+    def std_ns(self) -> float:
+        """
+        Returns the sample standard deviation of every interval, like SensorRunningStats.std()
+        """
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+    def rate_hz(self) -> float:
+        """
+        Returns the average number of frames per second over the whole session
+        """
+        return 1000000000 / self.mean_ns if self.mean_ns > 0 else 0.0
+
+
+    def recent_rate_hz(self) -> float:
+        """
+        Returns the average number of frames per second over the most recent intervals
+        """
+        return len(self.recent) * 1000000000 / self.recent_total_ns if self.recent_total_ns > 0 else 0.0
+
+
+def format_stage_latencies(histograms: dict) -> str:
+    """
+    Returns a line of p50/p95/p99/max latencies for every histogram in a dict of stage name to LatencyHistogram
+    """
+
+    msg = "Stage latency p50/p95/p99/max (us):\n"
+    for stage, histogram in histograms.items():
+        msg += f"    {stage}: {histogram.format()}\n"
+    return msg
+
+
+def save_stage_latencies(histograms: dict, path):
+    """
+    Writes every histogram in a dict of stage name to LatencyHistogram to a json file
+    """
+
+    with open(path, "w") as f:
+        json.dump({stage: histogram.data() for stage, histogram in histograms.items()}, f, indent=4)
@@ -0,0 +1,83 @@
+"""
+Command line program which records a session from the PMI without the GUI, eg on a data collection machine with no display.
+Run it from this folder, like GUI.py. Recording stops after --duration seconds, or on Ctrl+C / SIGTERM.
+Giving several ports records every mat at once, along with their time aligned frames (see multi_mat.py)
+"""
+
+import argparse, signal, threading
+
+from modules.acquisition import *
+from modules.calibration import Calibration, DEFAULT_CAL_CURVES_PATH
+from modules.multi_mat import MatConfig, MultiMatSession, ALIGNMENT_TOLERANCE_S
+from modules.session_file import WRITE_POLICIES, WRITE_POLICY_BLOCK, WRITE_QUEUE_SIZE
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ports", type=str, nargs='+', help="The com port(s) the mat(s) are plugged in to")
+    parser.add_argument("--baud", type=int, default=115200, help="The baud rate of the PMI")
+    parser.add_argument("--duration", type=float, default=None, help="Number of seconds to record for. Records until stopped if not given")
+    parser.add_argument("--cal_curves", type=str, nargs='+', default=[DEFAULT_CAL_CURVES_PATH], help="The calibration curves to apply, either one for every mat or one per port")
+    parser.add_argument("--async_io", action=argparse.BooleanOptionalAction, default=False, help="Read every mat from a single asyncio thread instead of a thread per mat")
+    parser.add_argument("--tolerance", type=float, default=ALIGNMENT_TOLERANCE_S, help="Largest number of seconds between the frames of different mats in an aligned set")
+    parser.add_argument("--sessions_folder", type=str, default=SESSIONS_FOLDER, help="The folder to create the session folder in")
+    parser.add_argument("--raw", action=argparse.BooleanOptionalAction, default=False, help="Record the raw readings and calibration instead of pressures")
+    parser.add_argument("--mode", type=str, default=ACQUISITION_MODE_LOSSLESS, choices=ACQUISITION_MODES, help="Process every frame, or only the newest frame when falling behind")
+    parser.add_argument("--write_policy", type=str, default=WRITE_POLICY_BLOCK, choices=WRITE_POLICIES, help="What to do when the disk can not keep up")
+    parser.add_argument("--write_queue_size", type=int, default=WRITE_QUEUE_SIZE, help="The number of frames that can wait to be written")
+    parser.add_argument("--stats_interval", type=float, default=5, help="Number of seconds between printing live statistics")
+    parser.add_argument("--quiet", action=argparse.BooleanOptionalAction, default=False, help="Do not print live statistics")
+
+    args = parser.parse_args()
+
+    if len(args.cal_curves) not in (1, len(args.ports)):
+        parser.error("give either one calibration curves file, or one per port")
+
+    calibrations = []
+    for cal_curves in args.cal_curves:
+        calibration = Calibration(ROW_WIDTH, COL_HEIGHT)
+        calibration.load_cal_curves(cal_curves)
+        calibrations.append(calibration)
+
+    if len(args.ports) > 1:
+        mats = [MatConfig(port, args.baud, calibrations[i % len(calibrations)]) for i, port in enumerate(args.ports)]
+        session = MultiMatSession(mats, sessions_folder=args.sessions_folder, tolerance_s=args.tolerance,
+                                  write_queue_size=args.write_queue_size, write_policy=args.write_policy, record_raw=args.raw,
+                                  on_stats=None if args.quiet else print, stats_interval_s=args.stats_interval,
+                                  async_io=args.async_io, mode=args.mode)
+
+        # every mat is read on a background thread, so the main thread just waits to be stopped
+        stopped = threading.Event()
+        signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+
+        try:
+            session.start()
+        except ValueError as e:
+            print(e)
+            raise SystemExit(1)
+        print(f"Recording {len(mats)} mats to {session.path}")
+
+        stopped.wait(args.duration)
+        session.stop()
+
+        print(session.summary())
+
+    else:
+        engine = AcquisitionEngine(args.ports[0], args.baud, calibrations[0], path=create_session_folder(args.sessions_folder),
+                                   write_queue_size=args.write_queue_size, write_policy=args.write_policy, record_raw=args.raw,
+                                   on_stats=None if args.quiet else print, stats_interval_s=args.stats_interval, mode=args.mode)
+        print(f"Recording {engine} to {engine.path}")
+
+        # stop cleanly on Ctrl+C, SIGTERM or once the duration is up, so every queued frame is written out
+        signal.signal(signal.SIGINT, lambda signum, frame: engine.stop())
+        signal.signal(signal.SIGTERM, lambda signum, frame: engine.stop())
+        if args.duration is not None:
+            timer = threading.Timer(args.duration, engine.stop)
+            timer.daemon = True
+            timer.start()
+
+        if not engine.run():
+            raise SystemExit(1)
+
+        print(engine.summary())
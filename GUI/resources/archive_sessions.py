@@ -0,0 +1,29 @@
+"""
+Command line program which compresses recorded session files into session archives for long term storage
+"""
+
+import argparse, sys
+from pathlib import Path
+
+# hack to allow importing the modules: add parent directory to path
+sys.path.append('..')
+from modules.session_archive import *
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", type=str, nargs='+', help="Session files, or folders containing session files, to archive")
+    parser.add_argument("--codec", type=str, default="zlib", choices=list(ARCHIVE_CODECS), help="The compression codec to use")
+    parser.add_argument("--chunk_size", type=int, default=ARCHIVE_CHUNK_SIZE, help="The number of frames compressed together")
+
+    args = parser.parse_args()
+
+    for path in [Path(p) for p in args.paths]:
+        session_paths = sorted(path.rglob("*" + SESSION_FILE_EXTENSION)) if path.is_dir() else [path]
+
+        for session_path in session_paths:
+            archive_path = archive_session(session_path, chunk_size=args.chunk_size, codec=args.codec)
+
+            session_size = session_path.stat().st_size
+            archive_size = Path(archive_path).stat().st_size
+            print(f"Archived {session_path} to {archive_path}: {session_size} -> {archive_size} bytes ({session_size / max(archive_size, 1):.1f}x smaller)")
@@ -0,0 +1,187 @@
+"""
+Program which benchmarks each stage of the host pipeline separately and end to end, on synthetic frames or a recorded session,
+so it is clear where the time between a frame arriving over serial and it being drawn goes. test_matspeed.py only times the
+serial link. Results are printed as json, and compared against a baseline so that regressions fail loudly
+"""
+
+import argparse, json, platform, sys, tempfile, time
+from pathlib import Path
+
+import numpy as np
+
+# hack to allow importing the modules: add parent directory to path
+sys.path.append('..')
+from modules.calibration import Calibration, MAX_RATED_PRESSURE_PA
+from modules.emulator import synthetic_frames, session_frames
+from modules.frame_parser import FrameParser
+from modules.mat_handler import *
+from modules.renderer import PressureRenderer
+from modules.session_file import SessionWriter, BackgroundSessionWriter
+
+BENCHMARK_BASELINE_PATH = "benchmark_baseline.json"
+BENCHMARK_TOLERANCE = 0.5       # fraction of a stage's baseline frame rate it may lose before it counts as a regression
+BENCHMARK_WARMUP_FRAMES = 20
+BENCHMARK_REPEATS = 5           # each stage is timed this many times and the fastest run is kept, to filter out noise
+
+
+def time_stage(stage, inputs: list, repeats: int=BENCHMARK_REPEATS) -> dict:
+    """
+    Runs stage(input) on every input, timing each call
+    returns: the frame rate and per frame latency percentiles of the fastest of repeats runs of the stage
+    """
+
+    for item in inputs[:BENCHMARK_WARMUP_FRAMES]:
+        stage(item)
+
+    total_ns = None
+    for repeat in range(repeats):
+        run_latencies_ns = np.empty(len(inputs), dtype=np.int64)
+        start_ns = time.perf_counter_ns()
+        for i, item in enumerate(inputs):
+            call_start_ns = time.perf_counter_ns()
+            stage(item)
+            run_latencies_ns[i] = time.perf_counter_ns() - call_start_ns
+        run_total_ns = time.perf_counter_ns() - start_ns
+
+        if total_ns is None or run_total_ns < total_ns:
+            total_ns, latencies_ns = run_total_ns, run_latencies_ns
+
+    latencies_us = latencies_ns / 1000
+    return {
+        "fps": len(inputs) / total_ns * 1000000000,
+        "p50_us": float(np.percentile(latencies_us, 50)),
+        "p95_us": float(np.percentile(latencies_us, 95)),
+        "p99_us": float(np.percentile(latencies_us, 99)),
+        "max_us": float(np.max(latencies_us)),
+    }
+
+
+def run_benchmarks(readings: list, calibration: Calibration, folder: Path) -> dict:
+    """
+    Benchmarks every stage of the pipeline on a list of (ROW_WIDTH, COL_HEIGHT) uint8 readings
+    returns: the results of each stage, by name
+    """
+
+    transmissions = [encode_mat_frame(reading) for reading in readings]
+    pressures = [calibration.apply_dc_offsets(calibration.apply_calibration_curve(reading)) for reading in readings]
+    renderer = PressureRenderer((ROW_WIDTH, COL_HEIGHT), MAX_RATED_PRESSURE_PA)
+    results = {}
+
+    # splitting the serial byte stream into frames
+    parser = FrameParser()
+    def parse(transmission):
+        parser.feed(transmission)
+        for frame in parser.frames():
+            pass
+    results["parse"] = time_stage(parse, transmissions)
+
+    # the same with checked frames, which also have their CRC and frame counter verified
+    checked_parser = FrameParser(FRAME_FORMAT_CHECKED)
+    def parse_checked(transmission):
+        checked_parser.feed(transmission)
+        for frame in checked_parser.frames():
+            pass
+    results["parse_checked"] = time_stage(parse_checked, [encode_mat_frame(reading, i) for i, reading in enumerate(readings)])
+
+    results["decode"] = time_stage(decode_mat_frame, transmissions)
+    results["decode_list"] = time_stage(mat_list_to_array, [list(transmission) for transmission in transmissions])
+    results["calibrate"] = time_stage(calibration.apply_calibration_curve, readings)
+    results["dc_offsets"] = time_stage(lambda pressure_array: calibration.apply_dc_offsets(pressure_array.copy()), pressures)
+
+    # persisting frames, both directly and through the writer thread as the acquisition engine does
+    with SessionWriter(folder.joinpath("benchmark.pmat"), (ROW_WIDTH, COL_HEIGHT)) as writer:
+        results["persist"] = time_stage(writer.append, pressures)
+    with BackgroundSessionWriter(SessionWriter(folder.joinpath("benchmark_background.pmat"), (ROW_WIDTH, COL_HEIGHT))) as writer:
+        results["persist_background"] = time_stage(writer.append, pressures)
+
+    results["stats"] = time_stage(lambda pressure_array: calc_mat_reading_stats(pressure_array, -1), pressures)
+    results["colorize"] = time_stage(renderer.colorize, pressures)
+    results["render"] = time_stage(renderer.render, pressures)
+
+    # everything a live session does with a frame, from the bytes read from serial to the image that is drawn
+    with SessionWriter(folder.joinpath("benchmark_end_to_end.pmat"), (ROW_WIDTH, COL_HEIGHT)) as writer:
+        end_to_end_parser = FrameParser()
+        def end_to_end(transmission):
+            end_to_end_parser.feed(transmission)
+            for frame in end_to_end_parser.frames():
+                pressure_array = calibration.apply_dc_offsets(calibration.apply_calibration_curve(decode_mat_frame(frame)))
+                writer.append(pressure_array)
+                calc_mat_reading_stats(pressure_array, -1)
+                renderer.colorize(pressure_array)
+        results["end_to_end"] = time_stage(end_to_end, transmissions)
+
+    return results
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares the frame rate of every stage to the baseline
+    returns: a message for every stage which is more than tolerance slower than the baseline, or has no baseline
+    """
+
+    regressions = []
+
+    # a stage missing from the baseline could regress unnoticed, so it fails until the baseline is saved again
+    for stage in results:
+        if stage not in baseline["stages"]:
+            regressions.append(f"{stage}: no baseline, run with --save_baseline to add it")
+
+    for stage, baseline_result in baseline["stages"].items():
+        if stage not in results:
+            continue
+
+        fps, baseline_fps = results[stage]["fps"], baseline_result["fps"]
+        if fps < baseline_fps * (1 - tolerance):
+            regressions.append(f"{stage}: {fps:.0f} fps is {(1 - fps / baseline_fps) * 100:.0f}% slower than the baseline of {baseline_fps:.0f} fps")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=2000, help="The number of frames to run through each stage")
+    parser.add_argument("--session", type=str, default=None, help="A recorded session to take frames from. Synthetic frames are used if not given")
+    parser.add_argument("--cal_curves", type=str, default="default_calibration_curves.npy", help="The calibration curves to apply")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic frames")
+    parser.add_argument("--output", type=str, default=None, help="File to write the json results to, as well as printing them")
+    parser.add_argument("--baseline", type=str, default=BENCHMARK_BASELINE_PATH, help="The baseline results to compare to")
+    parser.add_argument("--tolerance", type=float, default=BENCHMARK_TOLERANCE, help="Fraction of its baseline frame rate a stage may lose before failing")
+    parser.add_argument("--save_baseline", action=argparse.BooleanOptionalAction, help="Save the results as the new baseline instead of comparing to it")
+
+    args = parser.parse_args()
+
+    calibration = Calibration(ROW_WIDTH, COL_HEIGHT)
+    calibration.load_cal_curves(args.cal_curves)
+
+    frames = session_frames(args.session, calibration) if args.session is not None else synthetic_frames(args.seed)
+    readings = [next(frames) for i in range(args.frames)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        stages = run_benchmarks(readings, calibration, Path(folder))
+
+    results = {
+        "source": args.session if args.session is not None else "synthetic",
+        "frames": args.frames,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "stages": stages,
+    }
+    print(json.dumps(results, indent=4))
+
+    if args.output is not None:
+        Path(args.output).write_text(json.dumps(results, indent=4))
+
+    if args.save_baseline:
+        Path(args.baseline).write_text(json.dumps(results, indent=4))
+        print(f"Saved the results as the baseline in {args.baseline}", file=sys.stderr)
+        sys.exit(0)
+
+    if not Path(args.baseline).exists():
+        print(f"No baseline found at {args.baseline}, run with --save_baseline to create one", file=sys.stderr)
+        sys.exit(0)
+
+    regressions = compare_to_baseline(results["stages"], json.loads(Path(args.baseline).read_text()), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
@@ -10,8 +10,8 @@ Call with the index of the sensor you want to calibrate. Follow the instrutions
 import argparse, os
 from pathlib import Path
 import serial, sys
-import matplotlib.pyplot as plt
 import numpy as np
+import scipy.optimize
 
 # hack to allow importing the modules: add parent directory to path
 sys.path.append('..')
@@ -71,19 +71,16 @@ if __name__ == "__main__":
             ser.write((GET_CAL_VALS_COMMAND + '\n').encode('utf-8'))
         
             # mat data is transmitted as raw bytes
-            bytes = ser.read(VERIFICATION_WIDTH + MAT_SIZE)
-            if bytes == b'':
+            frame = ser.read(FRAME_SIZE)
+            if frame == b'':
                 print("Serial timed out!")
                 quit()
 
-            flat_mat = [x for x in bytes]
-
             # ensure that the verifiation message was aligned
-            for ver, val in zip(VERIFICATION_SEQUENCE, flat_mat[-4:]):
-                if not (ver == val):
-                    raise Exception("Verification sequence not found in mat transmission")
+            if not frame_is_aligned(frame):
+                raise Exception("Verification sequence not found in mat transmission")
 
-            data_array = mat_list_to_array(flat_mat)
+            data_array = decode_mat_frame(frame)
 
         # get just the value for the indexed sensor
         cal_vals[weight] = data_array[args.index_x, args.index_y]
@@ -105,6 +102,9 @@ if __name__ == "__main__":
         # save the cal curves
         np.save(cal_curves_folder.joinpath(f"cal_curve_({args.index_x}, {args.index_y}).npy"), np.array(params))
 
+        # matplotlib is slow to import, so only load it once there is something to plot
+        import matplotlib.pyplot as plt
+
         # plot the calibration curve
         plt.figure(1)
         x = np.linspace(0, 255, 100)
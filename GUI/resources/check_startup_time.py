@@ -0,0 +1,67 @@
+"""
+Program which measures how long the GUI and the headless recording modules take to import, and fails if any of them
+is over its budget or pulls in a heavy dependency that should only be imported when it is used (eg scipy for fitting).
+Every measurement is made in a fresh python process, so nothing is already imported
+"""
+
+import argparse, subprocess, sys
+from pathlib import Path
+
+import numpy as np
+
+GUI_FOLDER = Path(__file__).resolve().parent.parent
+
+# the modules to import, and the most time in milliseconds each may take to import
+IMPORT_BUDGETS_MS = {
+    "GUI": 400,
+    "modules.acquisition": 300,
+    "record_session": 300,
+}
+
+# dependencies which must only be imported once fitting, plotting or exporting actually happens
+LAZY_MODULES = ["scipy", "matplotlib", "PIL", "concurrent.futures.process"]
+
+
+def measure_import(module: str) -> tuple:
+    """
+    Imports module in a fresh python process
+    returns: the time the import took in milliseconds, and the list of LAZY_MODULES it imported
+    """
+
+    code = f"import sys; import {module}; print(','.join(m for m in {LAZY_MODULES} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=GUI_FOLDER, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to import {module}:\n{result.stderr}")
+
+    # -X importtime writes "import time: self [us] | cumulative | module" to stderr, with nested imports indented
+    import_us = 0
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and line.split("|")[-1] == " " + module:
+            import_us = int(line.split("|")[1])
+
+    lazy_imported = [m for m in result.stdout.strip().split(",") if m]
+    return import_us / 1000, lazy_imported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="The number of times to import each module. The median time is compared to the budget")
+    parser.add_argument("--scale", type=float, default=1, help="Multiplies every budget, eg for slower machines")
+
+    args = parser.parse_args()
+
+    failed = False
+    for module, budget_ms in IMPORT_BUDGETS_MS.items():
+        measurements = [measure_import(module) for i in range(args.runs)]
+        median_ms = np.median([ms for ms, lazy_imported in measurements])
+        lazy_imported = measurements[-1][1]
+        budget_ms *= args.scale
+
+        ok = median_ms <= budget_ms and not lazy_imported
+        failed |= not ok
+
+        print(f"{'ok  ' if ok else 'FAIL'} {module}: {median_ms:.1f}ms (budget {budget_ms:.0f}ms, cold start {measurements[0][0]:.1f}ms)")
+        if lazy_imported:
+            print(f"     imports {', '.join(lazy_imported)}, which should only be imported when used")
+
+    sys.exit(1 if failed else 0)
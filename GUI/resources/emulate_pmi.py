@@ -0,0 +1,72 @@
+"""
+Command line program which emulates the PMI on a pseudo-terminal, so the GUI and the other tools can be run without the board.
+Connect them to the port it prints. While it runs, faults can be injected by typing commands:
+    misalign [bytes]    send junk before the next frame
+    drop [bytes]        cut bytes out of the next frame
+    corrupt [frames]    change a byte in each of the next frames
+    reset               stop streaming, like power cycling the board
+    stats               print statistics about the emulator
+Only works on POSIX systems
+"""
+
+import argparse, sys, time
+
+# hack to allow importing the modules: add parent directory to path
+sys.path.append('..')
+from modules.calibration import Calibration
+from modules.emulator import *
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=EMULATOR_FRAME_RATE_HZ, help="Frames streamed per second. 0 streams as fast as the host reads")
+    parser.add_argument("--session", type=str, default=None, help="A recorded session to play back. Synthetic frames are sent if not given")
+    parser.add_argument("--cal_curves", type=str, default="default_calibration_curves.npy", help="The calibration curves used to convert sessions of pressures back to readings")
+    parser.add_argument("--no_loop", action=argparse.BooleanOptionalAction, help="Stop streaming after playing back the session once")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the synthetic frames and injected faults")
+    parser.add_argument("--misalign_every", type=int, default=0, help="Send junk before every this many frames. 0 disables")
+    parser.add_argument("--misalign_bytes", type=int, default=3, help="The number of junk bytes to send")
+    parser.add_argument("--drop_every", type=int, default=0, help="Cut bytes out of every this many frames. 0 disables")
+    parser.add_argument("--drop_bytes", type=int, default=3, help="The number of bytes to cut")
+    parser.add_argument("--corrupt_every", type=int, default=0, help="Change a byte of every this many frames. 0 disables")
+    parser.add_argument("--legacy", action=argparse.BooleanOptionalAction, help="Emulate a board which only sends legacy frames, without a counter or CRC")
+
+    args = parser.parse_args()
+
+    if args.session is not None:
+        calibration = Calibration(ROW_WIDTH, COL_HEIGHT)
+        calibration.load_cal_curves(args.cal_curves)
+        frames = session_frames(args.session, calibration, loop=not args.no_loop)
+    else:
+        frames = synthetic_frames(args.seed)
+
+    frame_formats = (FRAME_FORMAT_LEGACY,) if args.legacy else (FRAME_FORMAT_LEGACY, FRAME_FORMAT_CHECKED)
+    with VirtualPMI(frames, args.rate, args.misalign_every, args.misalign_bytes, args.drop_every, args.drop_bytes, args.seed,
+                    args.corrupt_every, frame_formats) as pmi:
+        print(f"Emulating the PMI on {pmi.port}", flush=True)
+
+        try:
+            for line in sys.stdin:
+                command = line.split()
+                if not command:
+                    continue
+
+                num_bytes = int(command[1]) if len(command) > 1 else None
+                if command[0] == "misalign":
+                    pmi.inject_misalignment(num_bytes)
+                elif command[0] == "drop":
+                    pmi.drop(num_bytes)
+                elif command[0] == "corrupt":
+                    pmi.corrupt(num_bytes if num_bytes is not None else 1)
+                elif command[0] == "reset":
+                    pmi.reset()
+                elif command[0] == "stats":
+                    print(pmi.stats())
+                else:
+                    print(f"Unknown command {command[0]}")
+
+            # keep emulating once stdin is closed, eg when run unattended
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt as e:
+            print(pmi.stats())
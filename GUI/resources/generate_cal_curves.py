@@ -2,10 +2,9 @@
 File which calculates calibration curves from the raw_data directory
 """
 
-import matplotlib.pyplot as plt
 import numpy as np
-from pathlib import Path
-import sys
+import scipy.optimize
+import argparse, sys
 
 # hack to allow importing the modules: add parent directory to path
 sys.path.append('..')
@@ -18,28 +17,36 @@ def fit_function(x, a, b, c):
 
 p0 = [0.0007204221429716851, 0.04216285053306005, 0.047785412782311236] # the initial parameters are taken from the averaged curve fit
 
+def print_progress(sensors_done, total_sensors):
+    print(f"   Fit {sensors_done}/{total_sensors} sensors with scipy")
+
+
 if __name__ == "__main__":
-    mat_readings = []
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scipy", action=argparse.BooleanOptionalAction, help="Fit every sensor with scipy's general solver instead of the batched solver")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes to fit sensors with scipy on. Defaults to the number of cpus")
 
-    data_files = Path("./raw_data").glob("*.csv")
+    args = parser.parse_args()
 
     calibration = Calibration(ROW_WIDTH, COL_HEIGHT, 2)
 
     print("Attempting to generate calibration curves...")
 
-    for path in data_files:
-        # create a MatReading for each saved mat reading and append it to the calibrator
-        reading = MatReading(ROW_WIDTH, COL_HEIGHT, 0, np.loadtxt(path, dtype=np.uint8, delimiter=','))
-        reading.actual_pressure = float(str(path).split('_')[2].split('pa')[0])
+    # create a MatReading for each saved mat reading and append it to the calibrator
+    for reading in load_calibration_readings("./raw_data"):
         calibration.add_reading(reading)
 
-    min_r2, avg_r2 = calibration.calculate_calibration_curves(drop_values_greater_than=500)
+    min_r2, avg_r2 = calibration.calculate_calibration_curves(drop_values_greater_than=500, use_scipy=bool(args.scipy), 
+                                                                  max_workers=args.workers, progress_callback=print_progress)
     print(f"Minimum R2 of all curves: {min_r2}. Average R2 for all curves: {avg_r2}")
 
     # save the calibration curves to a default
     np.save("default_calibration_curves.npy", calibration.cal_curves_array, allow_pickle=False)
     print("Saved calibrations to default_calibration_curves.npy")
 
+    # matplotlib is slow to import, so only load it once there is something to plot
+    import matplotlib.pyplot as plt
+
     plt.figure(1)
 
     # plot the calibration curves
@@ -32,19 +32,16 @@ if __name__ == "__main__":
         ser.write((GET_CAL_VALS_COMMAND + '\n').encode('utf-8'))
         
         # mat data is transmitted as raw bytes
-        bytes = ser.read(VERIFICATION_WIDTH + MAT_SIZE)
-        if bytes == b'':
+        frame = ser.read(FRAME_SIZE)
+        if frame == b'':
             print("Serial timed out!")
             quit()
-                
-        flat_mat = [x for x in bytes]
 
         # ensure that the verifiation message was aligned
-        for ver, val in zip(VERIFICATION_SEQUENCE, flat_mat[-4:]):
-            if not (ver == val):
-                raise Exception("Verification sequence not found in mat transmission")
+        if not frame_is_aligned(frame):
+            raise Exception("Verification sequence not found in mat transmission")
 
-        data_array = mat_list_to_array(flat_mat)
+        data_array = decode_mat_frame(frame)
 
         if args.no_save:
             print(f"{args.no_save=}, printing out the mat.")
@@ -2,7 +2,6 @@
 Program which calculates the sample rate of the mat without any calibration/data saving overhead
 """
 
-import matplotlib.pyplot as plt
 import numpy as np
 import sys, time, argparse
 
@@ -34,20 +33,17 @@ if __name__ == "__main__":
         try:
             while True:
                 # mat data is transmitted as raw bytes
-                bytes = ser.read(VERIFICATION_WIDTH + MAT_SIZE)
-                if bytes == b'':
+                frame = ser.read(FRAME_SIZE)
+                if frame == b'':
                     print("Serial timed out!")
                     continue
-                
-                flat_mat = [x for x in bytes]
 
                 # ensure that the verifiation message was aligned
-                for ver, val in zip(VERIFICATION_SEQUENCE, flat_mat[-4:]):
-                    if not (ver == val):
-                        print(f"Verification failure! On reading: \n{flat_mat}\nMade it {len(periods)} readings before failure")
-                        raise KeyboardInterrupt # give up
+                if not frame_is_aligned(frame):
+                    print(f"Verification failure! On reading: \n{list(frame)}\nMade it {len(periods)} readings before failure")
+                    raise KeyboardInterrupt # give up
 
-                flat_mat = flat_mat[-4:] # trim the verification sequence
+                data_array = decode_mat_frame(frame)
 
                 now = time.time_ns()
                 delta = now - prev_time
@@ -65,6 +61,9 @@ if __name__ == "__main__":
             print(f"Total run time in seconds: {time.time() - start_time}s")
             print(f"Average delta time between mat reads: {avg_period}ns")
             print(f"Total errors: {total_errors}")
+
+            # matplotlib is slow to import, so only load it once there is something to plot
+            import matplotlib.pyplot as plt
             plt.plot(periods)
             plt.show()
 